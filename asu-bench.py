@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Apple Security Updates Notifier v0.4.3b
+# File: asu-bench.py
+# Description: Offline benchmark of Apple Security Updates Notifier. It serves synthetic HT201222 pages from a local HTTP
+# server, runs asu-bot.py against them with notifications sent to a local sink, and reports per-stage timings, peak
+# memory and database growth.
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# asu-bot.py functions timed as stages, in pipeline order. pages_fetch only covers the HT201222 pages, advisories are
+# fetched within advisories_crawl
+stages = ['pages_fetch', 'page_extract', 'updates_scrape', 'check_updates', 'updates_database_update',
+          'build_message', 'digest_flush', 'outbox_dispatch', 'advisories_crawl']
+
+month_list = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre',
+              'noviembre', 'diciembre']
+products = ['iOS {0}.{1} y iPadOS {0}.{1}', 'macOS Sonoma 14.{1}', 'Safari 17.{1}', 'watchOS 10.{1}', 'tvOS 17.{1}',
+            'visionOS 1.{1}', 'Xcode 15.{1}']
+components = ['WebKit', 'Kernel', 'ImageIO', 'CoreMedia', 'Safari', 'Bluetooth', 'Find My', 'Shortcuts']
+# stages that parse HTML, compared between BeautifulSoup tree builders
+parse_stages = ['page_extract', 'updates_scrape']
+# rows link to a fixed set of advisory pages, like several products sharing one advisory
+advisory_count = 100
+targets = ['iPhone XS y posteriores', 'macOS Sonoma', 'macOS Monterey y macOS Ventura', 'Apple Watch Series 4 y '
+           'posteriores', 'Apple TV HD y Apple TV 4K (todos los modelos)', 'Apple Vision Pro']
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def load_bot(local_path):
+    spec = importlib.util.spec_from_file_location('asu_bot', f'{local_path}/asu-bot.py')
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+def page_rows(rows, base_url, offset=0):
+    generator = random.Random(rows + offset)
+    html_rows = []
+    for i in range(rows):
+        # rows are listed newest first, like the Apple page
+        days = offset + rows - i
+        year, month, day = 2015 + days // 336, days // 28 % 12, days % 28 + 1
+        product = generator.choice(products).format(10 + i % 8, i % 10)
+        target = generator.choice(targets)
+        date_str = f'{day} de {month_list[month]} de {year}'
+        if i % 5 == 0:
+            product_cell = f'{product}<br>Esta actualización no tiene entradas de CVE publicadas.'
+        else:
+            product_cell = f'<a href="{base_url}/es-cl/{100000 + i % advisory_count}">{product}</a>'
+        html_rows.append(f'<tr><td>{product_cell}</td><td>{target}</td><td>{date_str}</td></tr>')
+    return html_rows
+
+
+def build_page(html_rows, publish_date):
+    header = '<tr><th>Nombre y enlace a la información</th><th>Disponible para</th><th>Fecha de publicación</th></tr>'
+    return f"""<!DOCTYPE html>
+<html lang="es-cl"><head><meta charset="utf-8"><title>Actualizaciones de seguridad de Apple</title></head>
+<body><div id="sections"><h1>Actualizaciones de seguridad de Apple</h1>
+<p>{'Lorem ipsum dolor sit amet. ' * 50}</p>
+<div id="tableWraper"><table>{header}{''.join(html_rows)}</table></div>
+<div class="mod-date"><span>Fecha de publicación:</span> <time datetime="{publish_date}">{publish_date}</time></div>
+</div></body></html>"""
+
+
+def build_advisory(number):
+    generator = random.Random(number)
+    sections = []
+    for i in range(generator.randint(3, 12)):
+        sections.append(f'<h3>{generator.choice(components)}</h3><p>Disponible para: iPhone XS y posteriores</p>'
+                        f'<p>Impacto: El procesamiento de contenido web creado con fines malintencionados podría '
+                        f'provocar la ejecución de código arbitrario.</p><p>Descripción: Se solucionó un problema de '
+                        f'memoria mejorando la validación de entradas.</p><p>CVE-2024-{20000 + number * 20 + i}: '
+                        f'investigador anónimo</p>')
+    return f"""<!DOCTYPE html>
+<html lang="es-cl"><head><meta charset="utf-8"><title>Acerca del contenido de seguridad</title></head>
+<body><div id="sections"><h2>Acerca del contenido de seguridad</h2>{''.join(sections)}</div></body></html>"""
+
+
+def write_page(page_file, html_rows, publish_date, mtime):
+    with open(page_file, 'w', encoding='utf-8') as file:
+        file.write(build_page(html_rows, publish_date))
+    # http.server answers conditional requests by mtime, with one second resolution
+    os.utime(page_file, (mtime, mtime))
+
+
+def instrument(bot, timings):
+    lock = threading.Lock()
+    for name in stages:
+        function = getattr(bot, name)
+
+        def timed(*args, _function=function, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                with lock:
+                    timings[_name] = timings.get(_name, 0.0) + time.perf_counter() - start
+
+        setattr(bot, name, timed)
+
+
+def database_size(db_file):
+    # in WAL mode recent writes live in the -wal file until the next checkpoint
+    return sum(os.path.getsize(file) for file in (db_file, f'{db_file}-wal') if os.path.isfile(file))
+
+
+def run_scenario(bot, conn, timings, db_file):
+    timings.clear()
+    bot.check_date.cache_clear()
+    bot.render_row.cache_clear()
+    db_size = database_size(db_file)
+    tracemalloc.start()
+    start = time.perf_counter()
+    bot.run(conn)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {stage: timings.get(stage, 0.0) for stage in stages}
+    result['total'] = total
+    result['peak_kb'] = peak // 1024
+    result['db_growth_kb'] = (database_size(db_file) - db_size) // 1024
+    return result
+
+
+def parser_available(parser):
+    from bs4.builder import builder_registry
+    return builder_registry.lookup(parser) is not None
+
+
+def benchmark(local_path, rows, new_rows, chat_count, parser):
+    sink = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        page_dir = f'{work_dir}/es-cl'
+        os.mkdir(page_dir)
+        page_file = f'{page_dir}/HT201222'
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=work_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        for number in range(advisory_count):
+            with open(f'{page_dir}/{100000 + number}', 'w', encoding='utf-8') as file:
+                file.write(build_advisory(number))
+        config = {
+            'apple_url': f'{base_url}/es-cl/HT201222',
+            'db_file': f'{work_dir}/asu-bench.db',
+            'log_file': f'{work_dir}/asu-bench.log',
+            'timezone': 'UTC',
+            'bot_token': '123456789:bench',
+            'chat_ids': [f'-{1000000 + i}' for i in range(chat_count)],
+        }
+        with open(f'{work_dir}/config.json', 'w') as file:
+            json.dump(config, file)
+
+        bot = load_bot(local_path)
+        bot.get_config(work_dir)
+        bot.html_parser = parser
+        bot.apprise_send = lambda chat_id, apprise_message: sink.append(len(apprise_message))
+        timings = {}
+        instrument(bot, timings)
+        conn = bot.open_database()
+
+        results = {}
+        html_rows = page_rows(rows, base_url)
+        mtime = time.time() - 3600
+        write_page(page_file, html_rows, '2024-05-13', mtime)
+        results['first_run'] = run_scenario(bot, conn, timings, config['db_file'])
+        results['not_modified'] = run_scenario(bot, conn, timings, config['db_file'])
+
+        # new rows on top, plus one existing row whose link changed
+        html_rows = page_rows(new_rows, base_url, offset=rows) + html_rows
+        html_rows[new_rows + 1] = html_rows[new_rows + 1].replace('es-cl/', 'es-cl/kb/')
+        write_page(page_file, html_rows, '2024-05-20', mtime + 60)
+        results['changed'] = run_scenario(bot, conn, timings, config['db_file'])
+        results['notifications'] = len(sink)
+
+        conn.close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def print_report(report):
+    columns = stages + ['total']
+    print(f"asu-bench {report['version']}")
+    for parser, parser_results in report['results'].items():
+        for rows, results in parser_results.items():
+            print(f'\n{parser}, {rows} rows, {results["notifications"]} notifications sent to sink')
+            print(f"{'scenario':<14}" + ''.join(f'{column[:12]:>13}' for column in columns) + f"{'peak_kb':>10}"
+                  f"{'db_kb':>8}")
+            for scenario in ('first_run', 'not_modified', 'changed'):
+                result = results[scenario]
+                print(f'{scenario:<14}' + ''.join(f'{result[column] * 1000:>11.1f}ms' for column in columns) +
+                      f"{result['peak_kb']:>10}{result['db_growth_kb']:>8}")
+    if len(report['results']) > 1:
+        print('\nHTML parsing (page_extract + updates_scrape), first run:')
+        for rows in next(iter(report['results'].values())):
+            timings = [f"{parser} {sum(results[rows]['first_run'][stage] for stage in parse_stages) * 1000:.1f}ms"
+                       for parser, results in report['results'].items()]
+            print(f"{rows:>8} rows: {', '.join(timings)}")
+
+
+def compare(report, baseline, threshold):
+    regressions = []
+    for parser, parser_results in report['results'].items():
+        for rows, results in parser_results.items():
+            for scenario in ('first_run', 'not_modified', 'changed'):
+                previous = baseline.get('results', {}).get(parser, {}).get(rows, {}).get(scenario)
+                if previous is None:
+                    continue
+                for metric in stages + ['total', 'peak_kb']:
+                    old, new = previous.get(metric, 0), results[scenario][metric]
+                    # stages under 10 ms are too noisy to compare
+                    if metric != 'peak_kb' and old < 0.01:
+                        continue
+                    if old and new > old * (1 + threshold):
+                        regressions.append(f'{parser}, {rows} rows, {scenario}, {metric}: {old:.4f} -> {new:.4f}')
+    return regressions
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(prog='asu-bench',
+                                     description='Offline benchmark of the asu-bot.py pipeline against synthetic '
+                                                 'HT201222 pages served from a local HTTP server.')
+    parser.add_argument('-r', '--rows', default=[100, 1000, 10000], nargs='+', type=int,
+                        help='[optional] Page sizes to benchmark, in table rows (default: 100 1000 10000)')
+    parser.add_argument('-n', '--new-rows', default=10, type=int, help='[optional] Rows added between runs')
+    parser.add_argument('-c', '--chats', default=10, type=int, help='[optional] Number of chat ids to notify')
+    parser.add_argument('-p', '--parsers', default=['lxml', 'html.parser'], nargs='+',
+                        help='[optional] BeautifulSoup tree builders to compare, the ones not installed are skipped '
+                             '(default: lxml html.parser)')
+    parser.add_argument('-o', '--output', help='[optional] Save results as JSON to this file')
+    parser.add_argument('-b', '--baseline', help='[optional] JSON results of a previous version to compare with')
+    parser.add_argument('-t', '--threshold', default=0.2, type=float,
+                        help='[optional] Relative slowdown reported as a regression (default: 0.2)')
+    return parser.parse_args()
+
+
+def main():
+    args = argument_parser()
+    local_path = os.path.dirname(os.path.abspath(__file__))
+    with open(f'{local_path}/asu-notifier.json', 'r') as file:
+        version = json.load(file)['version']
+
+    report = {'version': version, 'results': {}}
+    for parser in args.parsers:
+        if not parser_available(parser):
+            print(f'{parser} is not installed, skipped.')
+            continue
+        report['results'][parser] = {}
+        for rows in args.rows:
+            report['results'][parser][str(rows)] = benchmark(local_path, rows, args.new_rows, args.chats, parser)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        if regressions:
+            print('\nRegressions:')
+            for regression in regressions:
+                print(f'  {regression}')
+            exit(1)
+        print('\nNo regressions.')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,48 +5,392 @@
 # Description: Secondary component of Apple Security Updates Notifier, which will run hourly and notify via Telegram any
 # new security update.
 
+import argparse
+import collections
+import contextlib
+import csv
 import hashlib
+import itertools
 import json
 import logging
 import os
 import os.path
+import random
 import re
+import signal
+import socket
 import sqlite3
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 from sqlite3 import Error, Connection
 from typing import TypeVar
+from urllib.parse import urljoin, urlsplit
 
-import pytz
 import requests
-from apprise import Apprise
-from bs4 import BeautifulSoup
+
+# apprise, bs4, pytz, asyncio, http.server, concurrent.futures, zstandard and pyarrow are imported by the functions
+# that use them, so a run that ends with a 304 or an unchanged hash never pays for loading them
 
 # set global variables
-global apple_url, db_file, log_file, localtime, bot_token, chat_ids
+global apple_urls, db_file, log_file, timezone, bot_token, chat_ids, poll_interval, poll_jitter, fetch_workers, \
+    dispatch_workers, max_attempts, message_format, metrics_file, metrics_port, cache_dir, advisory_max_age, \
+    snapshot_dir, api_port, bot_commands, lock_wait, lock_stale, digest_times, digest_size, quiet_hours, \
+    advisories_per_run
+
+# pooled HTTP session, reused for every request made by the bot
+session = requests.Session()
+
+# per-language rules for HT201222 pages, looked up by the language part of the locale in the url (es-cl -> es)
+locale_rules = {
+    'es': {
+        'date_patterns': [re.compile(r'(?P<day>\d{1,2}) de (?P<month>\w+) de (?P<year>\d{4})')],
+        'months': ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre',
+                   'noviembre', 'diciembre'],
+        'preinstalled': 'Preinstalado',
+        'no_cve_entries': 'Esta actualización no tiene entradas de CVE publicadas.',
+        'impact': 'Impacto:',
+        'description': 'Descripción:',
+        'latest_title': 'Últimas actualizaciones de Apple',
+        'new_title': 'Nuevas actualizaciones de Apple',
+        'modified_title': 'Actualizaciones de Apple modificadas',
+        'removed_title': 'Actualizaciones de Apple retiradas',
+        'search_title': 'Resultados de la búsqueda: {}',
+        'since_title': 'Actualizaciones de Apple desde {}',
+        'cve_title': 'Actualizaciones de Apple con {}',
+        'no_results': 'Sin resultados.',
+        'commands_help': 'Comandos: /latest [n], /search texto, /since AAAA-MM-DD, /cve CVE-AAAA-NNNN',
+    },
+    'en': {
+        'date_patterns': [re.compile(r'(?P<day>\d{1,2}) (?P<month>\w+) (?P<year>\d{4})'),
+                          re.compile(r'(?P<month>\w+) (?P<day>\d{1,2}), (?P<year>\d{4})')],
+        'months': ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+                   'november', 'december'],
+        'preinstalled': 'Preinstalled',
+        'no_cve_entries': 'This update has no published CVE entries.',
+        'impact': 'Impact:',
+        'description': 'Description:',
+        'latest_title': 'Latest Apple updates',
+        'new_title': 'New Apple updates',
+        'modified_title': 'Modified Apple updates',
+        'removed_title': 'Withdrawn Apple updates',
+        'search_title': 'Search results: {}',
+        'since_title': 'Apple updates since {}',
+        'cve_title': 'Apple updates with {}',
+        'no_results': 'No results.',
+        'commands_help': 'Commands: /latest [n], /search text, /since YYYY-MM-DD, /cve CVE-YYYY-NNNN',
+    },
+}
+for rules in locale_rules.values():
+    rules['months'] = {month: number for number, month in enumerate(rules['months'], start=1)}
+
+# rows released preinstalled on new devices have no date, they are stored with this one in every locale, and shown with
+# the 'preinstalled' word of their locale. It sorts before every date and is left out by date filters
+preinstalled_date = ''
+
+# metrics of the current run, and totals since the process started
+run_metrics = {}
+total_metrics = {}
+metrics_lock = threading.Lock()
+
+# cProfile output file and minimum run duration to keep a profile, set from the command line
+profile_file = None
+profile_min_seconds = 0.0
+
+# BeautifulSoup tree builder, None picks lxml when installed and html.parser otherwise. asu-bench.py sets it to compare
+# them
+html_parser = None
+
+# set while --replay rebuilds a database from snapshots, so past updates are not notified again
+replaying = False
+
+# Telegram rejects messages longer than this, longer notifications are split in several messages
+telegram_message_limit = 4096
+
+# archived rows are written to the database in batches of this size
+backfill_batch_size = 500
+
+# links to archive pages of older security releases, like /en-us/HT212146 or /es-cl/100100
+archive_link = re.compile(r'/[a-z]{2}-[a-z]{2}/(?:kb/)?(?:HT)?\d+/?$', re.IGNORECASE)
+archive_year = re.compile(r'\b(?:19|20)\d{2}\b')
+
+# CVE ids listed on advisory pages, like CVE-2024-23225
+cve_id = re.compile(r'CVE-\d{4}-\d{4,}')
+
+# words compared by subscription rules, like 'macos', 'sonoma' and '14.5' in 'macOS Sonoma 14.5'
+rule_token = re.compile(r'[\w.]+')
+
+# compiled subscription rules, rebuilt when the subscriptions table changes
+subscription_index = (None, None)
+
+# read-only connection shared by the HTTP API and the bot commands, and its responses cached until the next write
+api_conn = None
+api_db_file = None
+api_version = None
+api_cache = {}
+api_lock = threading.Lock()
+api_cache_size = 1024
+api_page_size = 50
+api_max_page_size = 500
+
+# exported columns, rows are read and written this many at a time so exports run in constant memory
+export_columns = ['update_id', 'update_date', 'update_product', 'update_target', 'update_link', 'file_hash', 'locale']
+export_batch_size = 1000
+export_formats = {'.csv': 'csv', '.jsonl': 'jsonl', '.parquet': 'parquet', '.arrow': 'arrow'}
+
+# escaping tables, applied in a single str.translate pass per field
+markdown_escape = str.maketrans({char: f'\\{char}' for char in '\\_*[]()~`>#+-=|{}.!'})
+markdown_link_escape = str.maketrans({char: f'\\{char}' for char in '\\)'})
+html_escape = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+# Apprise sends 'text' messages to Telegram in HTML mode, so the characters Telegram reads as markup are escaped
+text_escape = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+# search text is matched literally by LIKE, its wildcards are escaped
+like_escape = str.maketrans({char: f'\\{char}' for char in '\\%_'})
+
+# per-format templates, 'markdown' is Telegram MarkdownV2
+message_formats = {
+    'markdown': {
+        'escape': markdown_escape, 'link_escape': markdown_link_escape, 'title': '*{}*\n\n', 'date': '_{}_',
+        'link': '[{}]({})', 'product': '_{}_', 'separator': ' \\- ',
+    },
+    'html': {
+        'escape': html_escape, 'link_escape': html_escape, 'title': '<b>{}</b>\n\n', 'date': '<i>{}</i>',
+        'link': '<a href="{1}">{0}</a>', 'product': '<i>{}</i>', 'separator': ' - ',
+    },
+    'text': {
+        'escape': text_escape, 'link_escape': text_escape, 'title': '{}\n\n', 'date': '{}', 'link': '{} ({})',
+        'product': '{}', 'separator': ' - ',
+    },
+}
 
 # SQL queries
-sql_check_empty_table = """ SELECT COUNT(*) FROM main; """
-sql_last_hash: str = """ SELECT file_hash FROM main ORDER BY main_id DESC LIMIT 1; """
-sql_last_publish_date: str = """ SELECT publish_date FROM main ORDER BY main_id DESC LIMIT 1; """
-sql_main_table: str = """ INSERT INTO main (publish_date, file_hash, log_message) VALUES (?, ?, ?); """
-sql_updates_table: str = """ INSERT INTO updates (update_date, update_product, update_target, update_link, file_hash) 
-VALUES (?, ?, ?, ?, ?); """
-sql_get_updates: str = """SELECT update_date, update_product, update_target, update_link FROM updates ORDER BY 
-update_id DESC;"""
-sql_get_update_dates: str = """ SELECT DISTINCT update_date FROM updates ORDER BY update_id DESC LIMIT 5; """
-sql_get_date_updates: str = """SELECT update_date, update_product, update_target, update_link FROM updates WHERE 
-update_date = ? ORDER BY update_id DESC;"""
+sql_check_empty_table = """ SELECT COUNT(*) FROM main WHERE locale = ?; """
+sql_last_hash: str = """ SELECT file_hash FROM main WHERE locale = ? ORDER BY main_id DESC LIMIT 1; """
+sql_last_publish_date: str = """ SELECT publish_date FROM main WHERE locale = ? ORDER BY main_id DESC LIMIT 1; """
+sql_last_validators: str = """ SELECT etag, last_modified FROM main WHERE locale = ? ORDER BY main_id DESC LIMIT 1; """
+sql_main_table: str = """ INSERT INTO main (publish_date, file_hash, log_message, etag, last_modified, locale) 
+VALUES (?, ?, ?, ?, ?, ?); """
+sql_update_validators: str = """ UPDATE main SET etag = ?, last_modified = ? WHERE main_id = (SELECT MAX(main_id) FROM 
+main WHERE locale = ?); """
+sql_update_main: str = """ UPDATE main SET file_hash = ?, log_message = ?, etag = ?, last_modified = ? WHERE main_id = 
+(SELECT MAX(main_id) FROM main WHERE locale = ?); """
+sql_pragmas: list = [""" PRAGMA journal_mode = WAL; """, """ PRAGMA synchronous = NORMAL; """,
+                    """ PRAGMA busy_timeout = 5000; """, """ PRAGMA temp_store = MEMORY; """]
+sql_get_user_version: str = """ PRAGMA user_version; """
+sql_set_user_version: str = """ PRAGMA user_version = {}; """
+sql_create_main_table: str = """ CREATE TABLE IF NOT EXISTS main ( main_id integer PRIMARY KEY AUTOINCREMENT, 
+publish_date text NOT NULL, file_hash text NOT NULL, log_message text NOT NULL ); """
+sql_create_updates_table: str = """ CREATE TABLE IF NOT EXISTS updates ( update_id integer PRIMARY KEY AUTOINCREMENT, 
+update_date text NOT NULL, update_product text NOT NULL, update_target text NOT NULL, update_link text, file_hash text 
+NOT NULL ); """
+sql_create_main_index: str = """ CREATE INDEX IF NOT EXISTS main_locale ON main (locale, main_id); """
+sql_create_update_date_index: str = """ CREATE INDEX IF NOT EXISTS updates_date ON updates (locale, update_date); """
+sql_create_update_recent_index: str = """ CREATE INDEX IF NOT EXISTS updates_recent ON updates (update_date, update_id); 
+"""
+sql_table_columns: str = """ PRAGMA table_info({}); """
+sql_set_preinstalled: str = """ UPDATE OR IGNORE {} SET update_date = ? WHERE update_date IN ({}); """
+sql_delete_preinstalled_fingerprints: str = """ DELETE FROM fingerprints WHERE update_date IN ({}); """
+sql_add_column: str = """ ALTER TABLE {} ADD COLUMN {} text; """
+sql_set_locale: str = """ UPDATE {} SET locale = ? WHERE locale IS NULL; """
+sql_updates_table: str = """ INSERT OR IGNORE INTO updates (update_date, update_product, update_target, update_link, 
+file_hash, locale) VALUES (?, ?, ?, ?, ?, ?); """
+sql_check_update: str = """ SELECT update_id FROM updates WHERE update_date = ? AND update_product = ? AND update_target = ? 
+AND IFNULL(update_link, '') = ? AND locale = ? LIMIT 1; """
+sql_get_updates_index: str = """ SELECT sql FROM sqlite_master WHERE type='index' AND name='updates_natural_key'; """
+sql_drop_updates_index: str = """ DROP INDEX IF EXISTS updates_natural_key; """
+sql_delete_duplicate_updates: str = """ DELETE FROM updates WHERE update_id NOT IN (SELECT MIN(update_id) FROM updates 
+GROUP BY update_date, update_product, update_target, IFNULL(update_link, ''), locale); """
+sql_create_updates_index: str = """ CREATE UNIQUE INDEX IF NOT EXISTS updates_natural_key ON updates (update_date, 
+update_product, update_target, IFNULL(update_link, ''), locale); """
+sql_drop_fingerprints_table: str = """ DROP TABLE IF EXISTS fingerprints; """
+sql_create_fingerprints_table: str = """ CREATE TABLE IF NOT EXISTS fingerprints ( update_date text NOT NULL, 
+update_product text NOT NULL, update_target text NOT NULL, row_hash text NOT NULL, update_id integer, locale text NOT 
+NULL, PRIMARY KEY (locale, update_date, update_product, update_target) ); """
+sql_get_fingerprints: str = """ SELECT fingerprints.update_date, fingerprints.update_product, fingerprints.update_target, 
+updates.update_link, fingerprints.row_hash, fingerprints.update_id FROM fingerprints LEFT JOIN updates ON 
+fingerprints.update_id = updates.update_id WHERE fingerprints.locale = ?; """
+sql_fingerprints_table: str = """ INSERT OR REPLACE INTO fingerprints (update_date, update_product, update_target, 
+row_hash, locale, update_id) VALUES (?, ?, ?, ?, ?, (SELECT update_id FROM updates WHERE update_date = ? AND 
+update_product = ? AND update_target = ? AND IFNULL(update_link, '') = ? AND locale = ?)); """
+sql_delete_fingerprint: str = """ DELETE FROM fingerprints WHERE update_date = ? AND update_product = ? AND 
+update_target = ? AND locale = ?; """
+sql_modify_update: str = """ UPDATE OR IGNORE updates SET update_link = ?, file_hash = ? WHERE update_id = ?; """
+sql_create_outbox_table: str = """ CREATE TABLE IF NOT EXISTS outbox ( outbox_id integer PRIMARY KEY AUTOINCREMENT, 
+chat_id text NOT NULL, message text NOT NULL, status text NOT NULL DEFAULT 'pending', attempts integer NOT NULL DEFAULT 
+0, next_attempt real NOT NULL DEFAULT 0, last_error text, created_at text NOT NULL DEFAULT CURRENT_TIMESTAMP, sent_at 
+text ); """
+sql_create_outbox_index: str = """ CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt); """
+sql_outbox_table: str = """ INSERT INTO outbox (chat_id, message, next_attempt) VALUES (?, ?, ?); """
+sql_get_pending_outbox: str = """ SELECT outbox_id, chat_id, message, attempts FROM outbox WHERE status = 'pending' 
+AND next_attempt <= ? ORDER BY outbox_id; """
+sql_outbox_sent: str = """ UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL, 
+sent_at = CURRENT_TIMESTAMP WHERE outbox_id = ?; """
+sql_outbox_defer: str = """ UPDATE outbox SET next_attempt = ? WHERE outbox_id = ?; """
+sql_outbox_retry: str = """ UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt = ?, last_error = ? 
+WHERE outbox_id = ?; """
+sql_create_backfill_table: str = """ CREATE TABLE IF NOT EXISTS backfill ( url text NOT NULL, locale text NOT NULL, 
+status text NOT NULL DEFAULT 'pending', file_hash text, rows integer, completed_at text, PRIMARY KEY (url, locale) ); """
+sql_backfill_table: str = """ INSERT OR IGNORE INTO backfill (url, locale) VALUES (?, ?); """
+sql_get_backfill: str = """ SELECT url, status FROM backfill WHERE locale = ?; """
+sql_backfill_done: str = """ UPDATE backfill SET status = 'done', file_hash = ?, rows = ?, completed_at = CURRENT_TIMESTAMP 
+WHERE url = ? AND locale = ?; """
+sql_create_advisories_table: str = """ CREATE TABLE IF NOT EXISTS advisories ( url text PRIMARY KEY, locale text NOT NULL, 
+content_hash text, etag text, last_modified text, fetched_at real NOT NULL ); """
+sql_create_cves_table: str = """ CREATE TABLE IF NOT EXISTS cves ( update_link text NOT NULL, cve_id text NOT NULL, 
+component text, impact text, description text, PRIMARY KEY (update_link, cve_id) ); """
+sql_create_cves_index: str = """ CREATE INDEX IF NOT EXISTS cves_id ON cves (cve_id); """
+sql_create_update_link_index: str = """ CREATE INDEX IF NOT EXISTS updates_link ON updates (update_link); """
+sql_get_new_advisories: str = """ SELECT update_link, locale FROM updates WHERE update_link IS NOT NULL AND 
+update_link NOT IN (SELECT url FROM advisories) GROUP BY update_link, locale ORDER BY MAX(update_id) DESC LIMIT ?; """
+sql_get_stale_advisories: str = """ SELECT url, locale, content_hash, etag, last_modified FROM advisories WHERE 
+fetched_at < ? ORDER BY fetched_at LIMIT ?; """
+sql_advisories_table: str = """ INSERT OR REPLACE INTO advisories (url, locale, content_hash, etag, last_modified, 
+fetched_at) VALUES (?, ?, ?, ?, ?, ?); """
+sql_advisory_fetched: str = """ UPDATE advisories SET fetched_at = ? WHERE url = ?; """
+sql_delete_cves: str = """ DELETE FROM cves WHERE update_link = ?; """
+sql_cves_table: str = """ INSERT OR IGNORE INTO cves (update_link, cve_id, component, impact, description) VALUES (?, ?, 
+?, ?, ?); """
+sql_create_subscriptions_table: str = """ CREATE TABLE IF NOT EXISTS subscriptions ( subscription_id integer PRIMARY KEY 
+AUTOINCREMENT, chat_id text NOT NULL, product_pattern text, target_pattern text, min_date text, cves_only integer NOT 
+NULL DEFAULT 0, locale text, created_at text NOT NULL DEFAULT CURRENT_TIMESTAMP ); """
+sql_create_subscriptions_index: str = """ CREATE INDEX IF NOT EXISTS subscriptions_chat ON subscriptions (chat_id); """
+sql_subscriptions_table: str = """ INSERT INTO subscriptions (chat_id, product_pattern, target_pattern, min_date, 
+cves_only, locale) VALUES (?, ?, ?, ?, ?, ?); """
+sql_delete_subscriptions: str = """ DELETE FROM subscriptions WHERE chat_id = ?; """
+sql_get_subscriptions: str = """ SELECT chat_id, product_pattern, target_pattern, min_date, cves_only, locale FROM 
+subscriptions ORDER BY subscription_id; """
+sql_subscriptions_version: str = """ SELECT COUNT(*), MAX(subscription_id) FROM subscriptions; """
+sql_create_updates_fts: str = """ CREATE VIRTUAL TABLE IF NOT EXISTS updates_fts USING fts5(update_product, 
+update_target, content='updates', content_rowid='update_id'); """
+sql_create_fts_triggers: list = [
+    """ CREATE TRIGGER IF NOT EXISTS updates_fts_insert AFTER INSERT ON updates BEGIN INSERT INTO updates_fts (rowid, 
+update_product, update_target) VALUES (new.update_id, new.update_product, new.update_target); END; """,
+    """ CREATE TRIGGER IF NOT EXISTS updates_fts_delete AFTER DELETE ON updates BEGIN INSERT INTO updates_fts 
+(updates_fts, rowid, update_product, update_target) VALUES ('delete', old.update_id, old.update_product, 
+old.update_target); END; """,
+    """ CREATE TRIGGER IF NOT EXISTS updates_fts_update AFTER UPDATE ON updates BEGIN INSERT INTO updates_fts 
+(updates_fts, rowid, update_product, update_target) VALUES ('delete', old.update_id, old.update_product, 
+old.update_target); INSERT INTO updates_fts (rowid, update_product, update_target) VALUES (new.update_id, 
+new.update_product, new.update_target); END; """]
+sql_rebuild_updates_fts: str = """ INSERT INTO updates_fts (updates_fts) VALUES ('rebuild'); """
+sql_check_updates_fts: str = """ SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='updates_fts'; """
+sql_get_data_version: str = """ PRAGMA data_version; """
+sql_api_filters: str = """ (:locale IS NULL OR updates.locale = :locale) AND (:since IS NULL OR (update_date >= :since 
+AND update_date GLOB '[0-9]*')) AND (:until IS NULL OR (update_date <= :until AND update_date GLOB '[0-9]*')) AND 
+(:after_date IS NULL OR (update_date, updates.update_id) < (:after_date, :after_id)) ORDER BY update_date DESC, 
+updates.update_id DESC LIMIT :limit; """
+sql_api_updates: str = """ SELECT update_id, update_date, update_product, update_target, update_link, locale FROM 
+updates WHERE """ + sql_api_filters
+sql_api_search: str = """ SELECT updates.update_id, update_date, updates.update_product, updates.update_target, 
+update_link, locale FROM updates_fts JOIN updates ON updates.update_id = updates_fts.rowid WHERE updates_fts MATCH 
+:query AND """ + sql_api_filters
+sql_api_search_like: str = """ SELECT update_id, update_date, update_product, update_target, update_link, locale FROM 
+updates WHERE update_product || ' ' || update_target LIKE :pattern ESCAPE '\\' AND """ + sql_api_filters
+sql_api_cve: str = """ SELECT updates.update_id, update_date, update_product, update_target, updates.update_link, 
+locale FROM cves JOIN updates ON updates.update_link = cves.update_link WHERE cves.cve_id = :cve AND """ + \
+    sql_api_filters
+sql_api_cves: str = """ SELECT update_link, cve_id FROM cves WHERE update_link IN ({}) ORDER BY cve_id; """
+sql_create_chat_settings_table: str = """ CREATE TABLE IF NOT EXISTS chat_settings ( chat_id text PRIMARY KEY, timezone 
+text, digest_times text, digest_size integer, quiet_hours text ); """
+sql_create_digest_rows_table: str = """ CREATE TABLE IF NOT EXISTS digest_rows ( digest_id integer PRIMARY KEY 
+AUTOINCREMENT, chat_id text NOT NULL, title text NOT NULL, update_date text NOT NULL, update_product text NOT NULL, 
+update_target text NOT NULL, update_link text, locale text NOT NULL, created_at real NOT NULL ); """
+sql_create_digest_rows_index: str = """ CREATE INDEX IF NOT EXISTS digest_rows_chat ON digest_rows (chat_id, digest_id); 
+"""
+sql_get_chat_settings: str = """ SELECT chat_id, timezone, digest_times, digest_size, quiet_hours FROM chat_settings; """
+sql_chat_settings_table: str = """ INSERT OR REPLACE INTO chat_settings (chat_id, timezone, digest_times, digest_size, 
+quiet_hours) VALUES (?, ?, ?, ?, ?); """
+sql_digest_rows_table: str = """ INSERT INTO digest_rows (chat_id, title, update_date, update_product, update_target, 
+update_link, locale, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?); """
+sql_get_digest_chats: str = """ SELECT chat_id, COUNT(*), MIN(created_at), MAX(digest_id) FROM digest_rows GROUP BY 
+chat_id; """
+sql_get_digest_rows: str = """ SELECT title, update_date, update_product, update_target, update_link, locale FROM 
+digest_rows WHERE chat_id = ? AND digest_id <= ? ORDER BY digest_id; """
+sql_delete_digest_rows: str = """ DELETE FROM digest_rows WHERE chat_id = ? AND digest_id <= ?; """
+sql_get_subscribers: str = """ SELECT DISTINCT chat_id FROM subscriptions; """
+sql_get_snapshots: str = """ SELECT publish_date, file_hash, etag, last_modified, locale FROM main ORDER BY main_id; """
+sql_get_backfill_snapshots: str = """ SELECT url, locale, file_hash FROM backfill WHERE status = 'done' ORDER BY rowid; """
+sql_get_advisories: str = """ SELECT url, locale, content_hash, etag, last_modified, fetched_at FROM advisories; """
+sql_create_run_lock_table: str = """ CREATE TABLE IF NOT EXISTS run_lock ( lock_name text PRIMARY KEY, owner text NOT 
+NULL, host text NOT NULL, pid integer NOT NULL, acquired_at real NOT NULL, heartbeat real NOT NULL, released_at real, 
+result text ); """
+sql_get_run_lock: str = """ SELECT owner, host, pid, heartbeat, released_at, result FROM run_lock WHERE lock_name = 'run'; 
+"""
+sql_run_lock_acquire: str = """ INSERT OR REPLACE INTO run_lock (lock_name, owner, host, pid, acquired_at, heartbeat) 
+VALUES ('run', ?, ?, ?, ?, ?); """
+sql_run_lock_heartbeat: str = """ UPDATE run_lock SET heartbeat = ? WHERE lock_name = 'run' AND owner = ?; """
+sql_run_lock_release: str = """ UPDATE run_lock SET released_at = ?, result = ? WHERE lock_name = 'run' AND owner = ?; """
+sql_create_exports_table: str = """ CREATE TABLE IF NOT EXISTS exports ( export_file text PRIMARY KEY, update_id 
+integer NOT NULL, exported_at text NOT NULL DEFAULT CURRENT_TIMESTAMP ); """
+sql_get_export_mark: str = """ SELECT update_id FROM exports WHERE export_file = ?; """
+sql_export_mark: str = """ INSERT OR REPLACE INTO exports (export_file, update_id) VALUES (?, ?); """
+sql_export_pending: str = """ SELECT EXISTS (SELECT 1 FROM updates WHERE update_id > ?); """
+sql_export_updates: str = """ SELECT update_id, update_date, update_product, update_target, update_link, file_hash, 
+locale FROM updates WHERE update_id > ? ORDER BY update_id; """
+sql_get_latest_updates: str = """ SELECT update_date, update_product, update_target, update_link FROM ( SELECT 
+update_id, update_date, update_product, update_target, update_link, DENSE_RANK() OVER (ORDER BY update_date DESC) AS 
+date_rank FROM updates WHERE locale = ? ) WHERE date_rank <= ? ORDER BY update_date DESC, update_id DESC; """
 
 def get_config(local_path):
-    global apple_url, db_file, log_file, localtime, bot_token, chat_ids
-    config = open(f'{local_path}/config.json', 'r')
-    data = json.loads(config.read())
+    global apple_urls, db_file, log_file, timezone, bot_token, chat_ids, poll_interval, poll_jitter, fetch_workers, \
+        dispatch_workers, max_attempts, message_format, metrics_file, metrics_port, cache_dir, advisory_max_age, \
+        snapshot_dir, api_port, bot_commands, lock_wait, lock_stale, digest_times, digest_size, quiet_hours, \
+        advisories_per_run
+    with open(f'{local_path}/config.json', 'r') as config:
+        data = json.loads(config.read())
+    # every value is checked before any global changes, so a failed reload leaves the previous config in place
+    check_config(data)
     apple_url = data['apple_url']
+    apple_urls = apple_url if type(apple_url) is list else [apple_url]
     db_file = data['db_file']
     log_file = data['log_file']
     timezone = data['timezone']
-    localtime = pytz.timezone(timezone)
     bot_token = data['bot_token']
     chat_ids = data['chat_ids']
+    poll_interval = data.get('poll_interval', 300)
+    poll_jitter = data.get('poll_jitter', 30)
+    fetch_workers = data.get('fetch_workers', 4)
+    dispatch_workers = data.get('dispatch_workers', 8)
+    max_attempts = data.get('max_attempts', 5)
+    message_format = data.get('message_format', 'markdown')
+    metrics_file = data.get('metrics_file')
+    metrics_port = data.get('metrics_port')
+    cache_dir = data.get('cache_dir', f'{os.path.dirname(os.path.abspath(db_file))}/cache')
+    advisory_max_age = data.get('advisory_max_age', 7 * 24 * 3600)
+    advisories_per_run = data.get('advisories_per_run', 200)
+    snapshot_dir = data.get('snapshot_dir', f'{os.path.dirname(os.path.abspath(db_file))}/snapshots')
+    api_port = data.get('api_port')
+    bot_commands = data.get('bot_commands', False)
+    lock_wait = data.get('lock_wait', 300)
+    lock_stale = data.get('lock_stale', 600)
+    digest_times = tuple(sorted(data.get('digest_times', [])))
+    digest_size = data.get('digest_size', 30)
+    quiet_hours = data.get('quiet_hours')
+
+def check_config(data):
+    for key in ('apple_url', 'db_file', 'log_file', 'timezone', 'bot_token', 'chat_ids'):
+        if key not in data:
+            raise KeyError(key)
+    if data.get('message_format', 'markdown') not in message_formats:
+        raise ValueError(f"Invalid message format: {data['message_format']}")
+    apple_url = data['apple_url']
+    for url in apple_url if type(apple_url) is list else [apple_url]:
+        get_locale_rules(url_locale(url))
+    check_schedule(data.get('digest_times', []), data.get('quiet_hours') or '')
+
+def config_reload(local_path):
+    try:
+        get_config(local_path)
+    except (ValueError, KeyError, json.JSONDecodeError, OSError) as error:
+        logging.error(f'Configuration not reloaded, keeping the previous one: {error!r}')
+        return False
+    return True
+
+def get_localtime():
+    import pytz
+    return pytz.timezone(timezone)
 
 def create_connection(file):
     if not os.path.isfile(file):
@@ -54,160 +398,1537 @@ def create_connection(file):
     conn = TypeVar('conn', Connection, None)
     try:
         conn: Connection = sqlite3.connect(file)
+        # WAL lets readers work alongside the bot while it writes
+        for pragma in sql_pragmas:
+            conn.execute(pragma)
     except Error as error:
         logging.error(str(error))
     return conn
 
-def page_scrape(url, conn):
+def table_columns(cursor, table):
+    return [column[1] for column in cursor.execute(sql_table_columns.format(table)).fetchall()]
+
+def add_columns(cursor, table, new_columns):
+    columns = table_columns(cursor, table)
+    added = [column for column in new_columns if column not in columns]
+    for column in added:
+        cursor.execute(sql_add_column.format(table, column))
+    return added
+
+# Migrations are applied in order and recorded in PRAGMA user_version. Databases written before the runner existed
+# report version 0, so every step checks the current schema before changing it.
+def migration_base_tables(cursor, default_locale):
+    cursor.execute(sql_create_main_table)
+    cursor.execute(sql_create_updates_table)
+
+def migration_validators(cursor, default_locale):
+    add_columns(cursor, 'main', ('etag', 'last_modified'))
+
+def migration_locale(cursor, default_locale):
+    for table in ('main', 'updates'):
+        if add_columns(cursor, table, ('locale',)):
+            # rows stored before multi-locale support come from the first configured url
+            cursor.execute(sql_set_locale.format(table), (default_locale,))
+    index = cursor.execute(sql_get_updates_index).fetchone()
+    if index is None or 'locale' not in index[0]:
+        # databases created before the natural key index may hold duplicated rows
+        cursor.execute(sql_drop_updates_index)
+        cursor.execute(sql_delete_duplicate_updates)
+        cursor.execute(sql_create_updates_index)
+
+def migration_fingerprints(cursor, default_locale):
+    columns = table_columns(cursor, 'fingerprints')
+    if columns and 'locale' not in columns:
+        # fingerprints are rebuilt from the updates table on the next run
+        cursor.execute(sql_drop_fingerprints_table)
+    cursor.execute(sql_create_fingerprints_table)
+
+def migration_outbox(cursor, default_locale):
+    cursor.execute(sql_create_outbox_table)
+    cursor.execute(sql_create_outbox_index)
+
+def migration_indexes(cursor, default_locale):
+    cursor.execute(sql_create_main_index)
+    cursor.execute(sql_create_update_date_index)
+
+def migration_backfill(cursor, default_locale):
+    cursor.execute(sql_create_backfill_table)
+
+def migration_cves(cursor, default_locale):
+    cursor.execute(sql_create_advisories_table)
+    cursor.execute(sql_create_cves_table)
+    cursor.execute(sql_create_cves_index)
+    cursor.execute(sql_create_update_link_index)
+
+def migration_subscriptions(cursor, default_locale):
+    cursor.execute(sql_create_subscriptions_table)
+    cursor.execute(sql_create_subscriptions_index)
+
+def migration_search(cursor, default_locale):
+    try:
+        cursor.execute(sql_create_updates_fts)
+    except sqlite3.OperationalError as error:
+        # some SQLite builds ship without FTS5, search then falls back to LIKE
+        logging.warning(f'Full-text search not available: {error}')
+        return
+    for sql_create_trigger in sql_create_fts_triggers:
+        cursor.execute(sql_create_trigger)
+    cursor.execute(sql_rebuild_updates_fts)
+
+def migration_exports(cursor, default_locale):
+    cursor.execute(sql_create_exports_table)
+
+def migration_run_lock(cursor, default_locale):
+    cursor.execute(sql_create_run_lock_table)
+
+def migration_digests(cursor, default_locale):
+    cursor.execute(sql_create_chat_settings_table)
+    cursor.execute(sql_create_digest_rows_table)
+    cursor.execute(sql_create_digest_rows_index)
+
+def migration_recent_index(cursor, default_locale):
+    cursor.execute(sql_create_update_recent_index)
+
+def migration_preinstalled(cursor, default_locale):
+    # rows without a date were stored with the 'preinstalled' word of their locale
+    words = [rules['preinstalled'] for rules in locale_rules.values()]
+    marks = ', '.join('?' * len(words))
+    for table in ('updates', 'digest_rows'):
+        cursor.execute(sql_set_preinstalled.format(table, marks), (preinstalled_date, *words))
+    # their fingerprints are rebuilt by the next run, which finds the rows already stored and doesn't report them again
+    cursor.execute(sql_delete_preinstalled_fingerprints.format(marks), words)
+
+migrations = [migration_base_tables, migration_validators, migration_locale, migration_fingerprints, migration_outbox,
+              migration_indexes, migration_backfill, migration_cves, migration_subscriptions, migration_search,
+              migration_exports, migration_run_lock, migration_digests, migration_preinstalled, migration_recent_index]
+
+def migrate_database(conn, default_locale):
+    cursor = conn.cursor()
+    version = cursor.execute(sql_get_user_version).fetchone()[0]
+    for number, migration in enumerate(migrations, start=1):
+        if number <= version:
+            continue
+        # each migration runs in its own transaction, a failure leaves the database at the previous version
+        cursor.execute('BEGIN')
+        try:
+            migration(cursor, default_locale)
+            cursor.execute(sql_set_user_version.format(number))
+            conn.commit()
+        except Error as error:
+            conn.rollback()
+            logging.error(f'Database migration {number} ({migration.__name__}) failed: {error}')
+            raise
+        logging.info(f'\'{db_file}\' migrated to version {number} ({migration.__name__}).')
+
+@contextlib.contextmanager
+def metric_span(name):
+    start = time.perf_counter()
     try:
-        response = requests.get(url)
+        yield
+    finally:
+        metric_count(f'{name}_seconds', time.perf_counter() - start)
+
+def metric_count(name, value=1):
+    with metrics_lock:
+        run_metrics[name] = run_metrics.get(name, 0) + value
+
+def metric_total(name, value=1):
+    # counters of the API and bot commands, which serve requests between runs, are kept apart from the run metrics
+    with metrics_lock:
+        total_metrics[name] = total_metrics.get(name, 0) + value
+
+def metrics_text():
+    lines = []
+    with metrics_lock:
+        for name, value in sorted(run_metrics.items()):
+            lines.append(f'# TYPE asu_last_run_{name} gauge')
+            lines.append(f'asu_last_run_{name} {value}')
+        for name, value in sorted(total_metrics.items()):
+            if not name.endswith('_seconds'):
+                lines.append(f'# TYPE asu_{name}_total counter')
+                lines.append(f'asu_{name}_total {value}')
+    return '\n'.join(lines) + '\n'
+
+def metrics_export():
+    with metrics_lock:
+        for name, value in run_metrics.items():
+            total_metrics[name] = total_metrics.get(name, 0) + value
+        run_metrics['timestamp_seconds'] = round(time.time())
+        record = json.dumps({'event': 'run', **run_metrics}, sort_keys=True)
+    logging.info(record)
+    if metrics_file:
+        # written aside and renamed, so node_exporter never reads a half-written file
+        with open(f'{metrics_file}.tmp', 'w') as file:
+            file.write(metrics_text())
+        os.replace(f'{metrics_file}.tmp', metrics_file)
+
+def metrics_server_start(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    metrics_server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    return metrics_server
+
+def url_locale(url):
+    match = re.search(r'/([a-z]{2}-[a-z]{2})/', url.lower())
+    return match.group(1) if match else 'en-us'
+
+def conditional_headers(conn, locale):
+    headers = {}
+    validators = conn.cursor().execute(sql_last_validators, (locale,)).fetchone()
+    if validators is not None:
+        etag, last_modified = validators
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+    return headers
+
+def pages_scrape(urls, conn):
+    # fetches run concurrently, parsing and database writes stay on the calling thread
+    locales = [url_locale(url) for url in urls]
+    headers = [conditional_headers(conn, locale) for locale in locales]
+    responses = pages_fetch(urls, headers)
+    for locale, response in zip(locales, responses):
+        if response is None:
+            continue
+        # a page that fails to parse or store is retried on the next run, without stopping the other locales
+        try:
+            page_scrape(locale, response, conn)
+        except (Error, ValueError, IndexError, KeyError, AttributeError, TypeError) as error:
+            conn.rollback()
+            logging.error(f'Error scraping page - {locale}: {error!r}')
+            metric_count('scrape_errors')
+
+def pages_fetch(urls, headers):
+    if len(urls) == 1:
+        return [page_fetch(urls[0], headers[0])]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, min(fetch_workers, len(urls)))) as pool:
+        return list(pool.map(page_fetch, urls, headers))
+
+def page_fetch(url, headers):
+    try:
+        with metric_span('fetch'):
+            response = session.get(url, headers=headers, timeout=30)
+            content = response.content
     except requests.exceptions.RequestException as e:
         logging.error(f"Error fetching data from {url}: {e}")
-        exit()
+        metric_count('fetch_errors')
+        return None
+    metric_count('bytes_downloaded', len(content))
+    return response
+
+def page_scrape(locale, response, conn):
+    if response.status_code == 304:
+        logging.info(f'No updates available (not modified) - {locale}.')
+        metric_count('not_modified')
+        return
+    validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
     content = response.content
-    soup = BeautifulSoup(content, 'html.parser')
-    publish_date = soup.find('div', {'class': 'mod-date'}).time['datetime']
     file_hash = hashlib.sha256(content).hexdigest()
-    check_content(content, publish_date, file_hash, conn)
+    # servers ignoring conditional requests resend the same page, it is recognized by its hash before parsing it
+    last_hash = conn.cursor().execute(sql_last_hash, (locale,)).fetchone()
+    if last_hash is not None and last_hash[0] == file_hash:
+        # keep validators fresh so the next run can be answered with a 304
+        conn.cursor().execute(sql_update_validators, (*validators, locale))
+        conn.commit()
+        logging.info(f'No updates available - {locale}.')
+        metric_count('unchanged')
+        return
+    with metric_span('parse'):
+        publish_date, content_updates = page_extract(content)
+    snapshot_save(snapshot_dir, file_hash, content)
+    check_content(content_updates, publish_date, file_hash, validators, locale, conn)
+
+def snapshot_path(directory, content_hash):
+    return f'{directory}/{content_hash[:2]}/{content_hash}'
+
+def snapshot_codec():
+    # zstandard compresses pages better and faster than zlib, but it is optional
+    try:
+        import zstandard
+    except ImportError:
+        return '.zz', lambda data: zlib.compress(data, 9)
+    return '.zst', zstandard.ZstdCompressor(level=10).compress
+
+def snapshot_write(directory, content_hash, content):
+    # bodies are stored once per distinct content, keyed by the SHA256 the database already records
+    path = snapshot_path(directory, content_hash)
+    if os.path.isfile(f'{path}.zst') or os.path.isfile(f'{path}.zz'):
+        return
+    extension, compress = snapshot_codec()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as file:
+        file.write(compress(content))
+    os.replace(f'{path}.tmp', f'{path}{extension}')
+
+def snapshot_save(directory, content_hash, content):
+    # a failed snapshot only costs the ability to replay this page, it never stops a run
+    try:
+        snapshot_write(directory, content_hash, content)
+    except OSError as error:
+        logging.error(f'Error saving snapshot {content_hash}: {error}')
+
+def snapshot_read(directory, content_hash):
+    path = snapshot_path(directory, content_hash)
+    if os.path.isfile(f'{path}.zz'):
+        with open(f'{path}.zz', 'rb') as file:
+            return zlib.decompress(file.read())
+    if os.path.isfile(f'{path}.zst'):
+        import zstandard
+        with open(f'{path}.zst', 'rb') as file:
+            return zstandard.ZstdDecompressor().decompress(file.read())
+    return None
+
+def html_soup(content):
+    from bs4 import BeautifulSoup
+    from bs4.builder import builder_registry
+    # prefer lxml when installed, it is several times faster than the built-in html.parser
+    parser = html_parser or ('lxml' if builder_registry.lookup('lxml') else 'html.parser')
+    return BeautifulSoup(content, parser)
+
+def page_extract(content):
+    soup = html_soup(content)
+    publish_date = soup.find('div', {'class': 'mod-date'}).time['datetime']
+    content_updates = soup.find('div', id="tableWraper").find_all('tr')
+    return publish_date, content_updates
 
-def check_content(content, publish_date, file_hash, conn):
+def check_content(content_updates, publish_date, file_hash, validators, locale, conn):
     cursor = conn.cursor()
-    count = cursor.execute(sql_check_empty_table).fetchone()[0]
+    count = cursor.execute(sql_check_empty_table, (locale,)).fetchone()[0]
     if count == 0:
-        update_databases(conn, content, publish_date, file_hash, full_update=True)
+        update_databases(conn, content_updates, publish_date, file_hash, validators, locale, full_update=True)
     else:
-        query_hash = cursor.execute(sql_last_hash).fetchone()[0]
-        query_date = cursor.execute(sql_last_publish_date).fetchone()[0]
-        if query_hash == file_hash and query_date == publish_date:
-            logging.info('No updates available.')
-            exit()
-        elif query_hash != file_hash and query_date == publish_date:
-            logging.info('No updates available but, there are differences in file hash. Check url for eventual changes.')
-            exit()
-        else:
-            update_databases(conn, content, publish_date, file_hash, full_update=False)
+        # unchanged pages are recognized by their hash in page_scrape, before parsing them
+        query_date = cursor.execute(sql_last_publish_date, (locale,)).fetchone()[0]
+        update_databases(conn, content_updates, publish_date, file_hash, validators, locale, full_update=False,
+                         same_date=query_date == publish_date)
 
-def update_databases(conn, content, publish_date, file_hash, full_update):
-    main_database_update(conn, publish_date, file_hash, full_update)
-    updates_database_update(conn, content, file_hash, full_update)
-    conn.close()
+def update_databases(conn, content_updates, publish_date, file_hash, validators, locale, full_update, same_date=False):
+    main_database_update(conn, publish_date, file_hash, validators, locale, full_update, same_date)
+    updates_database_update(conn, content_updates, file_hash, locale, full_update)
 
-def main_database_update(conn, publish_date, file_hash, full_update):
+def main_database_update(conn, publish_date, file_hash, validators, locale, full_update, same_date):
     cursor = conn.cursor()
     if full_update:
         log_message = f'\'main\' table first update - SHA256: {file_hash}.'
     else:
         log_message = f'\'main\' table updated - SHA256: {file_hash}.'
-    cursor.execute(sql_main_table, (publish_date, file_hash, log_message))
+    if same_date:
+        # pages changed without a new publish date update the row of that date, instead of adding one per change
+        cursor.execute(sql_update_main, (file_hash, log_message, *validators, locale))
+    else:
+        cursor.execute(sql_main_table, (publish_date, file_hash, log_message, *validators, locale))
     logging.info(log_message)
-    conn.commit()
 
-def updates_database_update(conn, content, file_hash, full_update):
+def updates_database_update(conn, content_updates, file_hash, locale, full_update):
     cursor = conn.cursor()
-    soup = BeautifulSoup(content, 'html.parser')
-    content_updates = soup.find('div', id="tableWraper").find_all('tr')
-    updates = updates_scrape(content_updates)
-    new_updates = check_updates(cursor, updates)
-    if new_updates != 'None' or full_update:
+    with metric_span('parse'):
+        updates = updates_scrape(content_updates, locale)
+    metric_count('rows_parsed', len(updates))
+    identities = updates_identities(updates)
+    if full_update:
+        new_updates, modified_updates, removed_updates, archived_updates = updates, [], [], []
+    else:
+        with metric_span('diff'):
+            new_updates, modified_updates, removed_updates, archived_updates = check_updates(cursor, updates,
+                                                                                             identities, locale)
+    metric_count('new_rows', len(new_updates))
+    metric_count('modified_rows', len(modified_updates))
+    metric_count('removed_rows', len(removed_updates))
+    metric_count('archived_rows', len(archived_updates))
+    if new_updates or modified_updates or removed_updates or full_update:
         if full_update:
             log_message = f'\'updates\' table first update - SHA256: {file_hash}.'
-            new_updates = updates
         else:
-            log_message = f'\'updates\' table updated - SHA256: {file_hash}.'
-        for element in reversed(new_updates):
-            cursor.execute(sql_updates_table, (element[0], element[1], element[2], element[3], file_hash))
-        conn.commit()
+            log_message = (f'\'updates\' table updated ({len(new_updates)} new, {len(modified_updates)} modified, '
+                           f'{len(removed_updates)} removed) - SHA256: {file_hash}.')
+        with metric_span('db_write'):
+            cursor.executemany(sql_updates_table, [(*element, file_hash, locale)
+                                                   for element in reversed(new_updates)])
+            cursor.executemany(sql_modify_update, [(element[3], file_hash, update_id)
+                                                   for element, update_id in modified_updates])
+            fingerprints_update(cursor, identities, removed_updates + archived_updates, locale)
+        modified_updates = [element for element, update_id in modified_updates]
+        if not replaying:
+            with metric_span('render'):
+                build_message(conn, new_updates, modified_updates, removed_updates, locale, full_update)
+        # rows and the notifications they need are committed together, so a crash never loses a message
+        with metric_span('db_write'):
+            conn.commit()
         logging.info(log_message)
-        apprise_notification(conn, new_updates, full_update)
-        conn.commit()
+    else:
+        with metric_span('db_write'):
+            fingerprints_update(cursor, identities, removed_updates + archived_updates, locale)
+            conn.commit()
+        logging.info('No updates available but, there are differences in file hash. Check url for eventual changes.')
+
+def row_hash(update):
+    return hashlib.sha256('\x1f'.join(field or '' for field in update).encode('utf-8')).hexdigest()
+
+def updates_identities(updates):
+    # a row repeated on the page with the same (date, product, target) shares one fingerprint, the one of its first
+    # occurrence
+    identities = {}
+    for update in updates:
+        identities.setdefault(update[:3], update)
+    return identities
 
-def check_updates(cursor, latest_updates):
-    existing_updates = cursor.execute(sql_get_updates).fetchall()
+def check_updates(cursor, updates, identities, locale):
+    # fingerprints hold the rows seen on the page in the previous run, keyed by (date, product, target)
+    fingerprints = {}
+    for update_date, update_product, update_target, update_link, fingerprint, update_id in cursor.execute(
+            sql_get_fingerprints, (locale,)):
+        fingerprints[(update_date, update_product, update_target)] = (update_link, fingerprint, update_id)
     new_updates = []
-    for update in latest_updates:
-        if tuple(update) not in existing_updates:
+    modified_updates = []
+    for update in updates:
+        identity = update[:3]
+        previous = fingerprints.get(identity)
+        if previous is not None and identities[identity] is update:
+            if previous[1] != row_hash(update):
+                modified_updates.append((update, previous[2]))
+            continue
+        # rows stored before fingerprints existed are only recorded, not reported. Repeated rows are looked up by their
+        # natural key, which includes the link, so every one of them is stored like in a full update
+        existing = cursor.execute(sql_check_update, (*identity, update[3] or '', locale))
+        if existing.fetchone() is None:
             new_updates.append(update)
-    return new_updates
+    # Apple moves older releases to archive pages, so only missing rows dated on or after the oldest date still listed
+    # were withdrawn. Older rows, and preinstalled ones, which have no date, were archived and are not reported
+    oldest = min((identity[0] for identity in identities if identity[0] != preinstalled_date), default=None)
+    removed_updates = []
+    archived_updates = []
+    for identity, previous in fingerprints.items():
+        if identity in identities:
+            continue
+        if oldest is not None and identity[0] >= oldest:
+            removed_updates.append((*identity, previous[0]))
+        else:
+            archived_updates.append((*identity, previous[0]))
+    return new_updates, modified_updates, removed_updates, archived_updates
+
+def fingerprints_update(cursor, identities, removed_updates, locale):
+    fingerprints = []
+    for update in identities.values():
+        update_date, update_product, update_target, update_link = update
+        fingerprints.append((update_date, update_product, update_target, row_hash(update), locale,
+                             update_date, update_product, update_target, update_link or '', locale))
+    cursor.executemany(sql_fingerprints_table, fingerprints)
+    cursor.executemany(sql_delete_fingerprint, [(*element[:3], locale) for element in removed_updates])
+
+def get_locale_rules(locale):
+    language = locale.split('-')[0]
+    if language not in locale_rules:
+        raise ValueError(f"Unsupported locale: {locale}")
+    return locale_rules[language]
 
-def updates_scrape(content_updates):
-    updates = []
+def updates_scrape(content_updates, locale):
+    return list(updates_rows(content_updates, locale))
+
+def updates_rows(content_updates, locale):
+    rules = get_locale_rules(locale)
     for row in content_updates[1:]:
         columns = row.find_all('td')
-        update_link = columns[0].find('a')['href'] if columns[0].find('a') else None
-        product_name = columns[0].get_text().strip().replace('Esta actualización no tiene entradas de CVE publicadas.',
-                                                             '').replace('\xa0', ' ').replace('\n', '')
+        anchor = columns[0].find('a', href=True)
+        update_link = anchor['href'] if anchor is not None else None
+        product_name = columns[0].get_text().strip().replace(rules['no_cve_entries'], '').replace('\xa0', ' ').replace(
+            '\n', '')
         update_target = columns[1].get_text().strip().replace('\xa0', ' ').replace('\n', '')
         date_str = columns[2].get_text().strip().replace('\xa0', ' ').replace('\n', '')
-        if date_str == 'Preinstalado':
-            update_date = date_str
+        if date_str == rules['preinstalled']:
+            update_date = preinstalled_date
         else:
-            update_date = check_date(date_str)
-        updates_row = (update_date, product_name, update_target, update_link)
-        updates.append(updates_row)
-    return updates
-
-def check_date(date_str):
-    pattern = r'(\d{1,2}) de (\w+) de (\d{4})'
-    match = re.match(pattern, date_str)
-    if not match:
+            update_date = check_date(date_str, locale)
+        yield update_date, product_name, update_target, update_link
+
+@lru_cache(maxsize=1024)
+def check_date(date_str, locale):
+    rules = get_locale_rules(locale)
+    for pattern in rules['date_patterns']:
+        match = pattern.match(date_str)
+        if match:
+            break
+    else:
         raise ValueError(f"Invalid date format: {date_str}")
-    day, month, year = match.groups()
-    month_list = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre',
-                  'noviembre', 'diciembre']
-    try:
-        month_num = month_list.index(month.lower()) + 1
-    except ValueError:
+    day, month, year = match.group('day', 'month', 'year')
+    month_num = rules['months'].get(month.lower())
+    if month_num is None:
         raise ValueError(f"Invalid month name: {month}")
     new_date = f'{year}-{str(month_num).zfill(2)}-{str(day).zfill(2)}'
     return new_date
 
-def apprise_notification(conn, updates, full_update):
+def outbox_enqueue(cursor, apprise_messages):
+    schedules = schedules_load(cursor)
+    now = time.time()
+    outbox_rows = []
+    for message_chat_ids, chunks in apprise_messages:
+        for chat_id in message_chat_ids:
+            # messages falling in the quiet hours of a chat are held until they end
+            next_attempt = quiet_until(chat_schedule(schedules, chat_id), now)
+            outbox_rows += [(chat_id, apprise_message, next_attempt) for apprise_message in chunks]
+    cursor.executemany(sql_outbox_table, outbox_rows)
+
+def check_schedule(times, quiet):
+    for value in (*times, *quiet.split('-')):
+        if value and not re.fullmatch(r'([01]\d|2[0-3]):[0-5]\d', value):
+            raise ValueError(f"Invalid time format: {value}")
+    if quiet and quiet.count('-') != 1:
+        raise ValueError(f"Invalid quiet hours: {quiet}")
+
+def schedules_load(cursor):
+    return {row[0]: row[1:] for row in cursor.execute(sql_get_chat_settings)}
+
+def chat_schedule(schedules, chat_id):
+    # chat settings left empty fall back to the timezone, digest_times, digest_size and quiet_hours of config.json
+    chat_timezone, chat_times, chat_size, chat_quiet = schedules.get(chat_id, (None, None, None, None))
+    times = digest_times if chat_times is None else tuple(sorted(filter(None, chat_times.split(','))))
+    quiet = quiet_hours if chat_quiet is None else chat_quiet
+    return chat_timezone or timezone, times, chat_size or digest_size, tuple(quiet.split('-')) if quiet else None
+
+def chat_localtime(chat_timezone):
+    import pytz
+    return get_localtime() if chat_timezone == timezone else pytz.timezone(chat_timezone)
+
+def local_timestamp(tz, day, clock):
+    hour, minute = map(int, clock.split(':'))
+    return tz.localize(datetime(day.year, day.month, day.day, hour, minute)).timestamp()
+
+def quiet_until(schedule, now):
+    # returns when the current quiet hours of the chat end, or 0 outside them
+    chat_timezone, times, size, quiet = schedule
+    if quiet is None:
+        return 0
+    tz = chat_localtime(chat_timezone)
+    local = datetime.fromtimestamp(now, tz)
+    clock = local.strftime('%H:%M')
+    start, end = quiet
+    if not (start <= clock < end if start <= end else clock >= start or clock < end):
+        return 0
+    day = local.date() if clock < end else local.date() + timedelta(days=1)
+    return local_timestamp(tz, day, end)
+
+def digest_due(schedule, count, oldest, now):
+    chat_timezone, times, size, quiet = schedule
+    if quiet_until(schedule, now):
+        return False
+    # rows left in the buffer after the digest times of a chat were cleared are sent right away
+    if not times or count >= size:
+        return True
+    # a digest is sent once a digest time has passed since its oldest row was buffered
+    tz = chat_localtime(chat_timezone)
+    today = datetime.fromtimestamp(now, tz).date()
+    for day in (today, today - timedelta(days=1)):
+        for clock in reversed(times):
+            window = local_timestamp(tz, day, clock)
+            if window <= now:
+                return window > oldest
+    return False
+
+def digest_buffer(cursor, selections, locale):
+    # rows are kept in digest_rows for every chat, until digest_flush finds the chat due
+    now = time.time()
+    digest_rows = [(chat_id, title, *element, locale, now) for selection_chat_ids, selected in selections
+                   for chat_id in selection_chat_ids for title, elements in selected for element in elements]
+    cursor.executemany(sql_digest_rows_table, digest_rows)
+    metric_count('digest_rows', len(digest_rows))
+
+def digest_flush(conn):
+    cursor = conn.cursor()
+    schedules = schedules_load(cursor)
+    now = time.time()
+    buffers = {}
+    for chat_id, count, oldest, last_id in cursor.execute(sql_get_digest_chats).fetchall():
+        if not digest_due(chat_schedule(schedules, chat_id), count, oldest, now):
+            continue
+        # chats with the same buffered rows share one rendered message
+        buffered = tuple(cursor.execute(sql_get_digest_rows, (chat_id, last_id)).fetchall())
+        buffers.setdefault(buffered, []).append(chat_id)
+        cursor.execute(sql_delete_digest_rows, (chat_id, last_id))
+    if buffers:
+        with metric_span('render'):
+            apprise_messages = [(buffer_chat_ids, message_chunks(digest_parts(buffered)))
+                                for buffered, buffer_chat_ids in buffers.items()]
+        outbox_enqueue(cursor, apprise_messages)
+        conn.commit()
+        chats = sum(len(buffer_chat_ids) for buffer_chat_ids in buffers.values())
+        metric_count('chats_notified', chats)
+        logging.info(f'Notifications queued for {chats} chats.')
+
+def digest_parts(buffered):
+    # one message per chat, with the buffered rows of every locale grouped by locale and section
+    locales = {}
+    for title, *element, locale in buffered:
+        locales.setdefault(locale, {}).setdefault(title, []).append(tuple(element))
+    parts = []
+    for locale, sections in locales.items():
+        header = render_title(locale) if len(apple_urls) > 1 else ''
+        parts += message_parts(header, list(sections.items()), locale)
+    return parts
+
+def schedule_set(conn, chat_id, chat_timezone, times, size, quiet):
+    if chat_timezone is not None:
+        import pytz
+        if chat_timezone not in pytz.all_timezones_set:
+            raise ValueError(f"Invalid timezone: {chat_timezone}")
+    check_schedule(times or (), quiet or '')
+    cursor = conn.cursor()
+    settings = schedules_load(cursor).get(chat_id, (None, None, None, None))
+    # options left out keep their previous value, an empty --digest-at or --quiet turns the setting off
+    settings = (chat_timezone if chat_timezone is not None else settings[0],
+                ','.join(times) if times is not None else settings[1],
+                size if size is not None else settings[2],
+                quiet if quiet is not None else settings[3])
+    cursor.execute(sql_chat_settings_table, (chat_id, *settings))
+    conn.commit()
+    logging.info(f'Notification schedule of {chat_id} set.')
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Telegram allows about 30 messages per second overall and 20 messages per minute to the same group
+global_bucket = TokenBucket(rate=30, capacity=30)
+chat_buckets = {}
+chat_buckets_lock = threading.Lock()
+
+def chat_bucket(chat_id):
+    with chat_buckets_lock:
+        if chat_id not in chat_buckets:
+            chat_buckets[chat_id] = TokenBucket(rate=20 / 60, capacity=3)
+        return chat_buckets[chat_id]
+
+def apprise_send(chat_id, apprise_message):
+    chat_bucket(chat_id).acquire()
+    global_bucket.acquire()
+    from apprise import Apprise
     apprise_object = Apprise()
-    apprise_message = build_message(conn, updates, full_update)
-    apprise_syntax = f'tgram://{bot_token}/'
-    for chat_id in chat_ids:
-        apprise_syntax += f'{chat_id}/'
-    apprise_syntax += '?format=markdown'
-    apprise_object.add(apprise_syntax, tag='telegram')
-    apprise_object.notify(apprise_message, tag="telegram")
-
-def build_message(conn, updates, full_update):
+    apprise_object.add(f'tgram://{bot_token}/{chat_id}/?format={message_format}&mdv=v2', tag='telegram')
+    try:
+        if apprise_object.notify(apprise_message, tag='telegram'):
+            return None
+        return 'notification not delivered'
+    except Exception as error:
+        return str(error)
+
+def apprise_send_chat(chat_id, pending):
+    # messages for one chat are sent in order, and sending stops at the first failure
+    results = []
+    for outbox_id, apprise_message in pending:
+        error = apprise_send(chat_id, apprise_message)
+        results.append((outbox_id, error))
+        if error is not None:
+            break
+    return results
+
+def outbox_dispatch(conn):
     cursor = conn.cursor()
-    last_updates = []
+    pending = {}
+    for outbox_id, chat_id, apprise_message, attempts in cursor.execute(sql_get_pending_outbox, (time.time(),)):
+        pending.setdefault(chat_id, []).append((outbox_id, apprise_message, attempts))
+    if not pending:
+        return
+    # chats are served concurrently, delivery state is written back on the calling thread
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, min(dispatch_workers, len(pending)))) as pool:
+        results = list(pool.map(apprise_send_chat, pending.keys(),
+                                [[row[:2] for row in rows] for rows in pending.values()]))
+    sent = failed = 0
+    for (chat_id, rows), chat_results in zip(pending.items(), results):
+        for (outbox_id, apprise_message, attempts), (_, error) in zip(rows, chat_results):
+            if error is None:
+                cursor.execute(sql_outbox_sent, (outbox_id,))
+                sent += 1
+                continue
+            attempts += 1
+            status = 'failed' if attempts >= max_attempts else 'pending'
+            next_attempt = time.time() + min(60 * 2 ** attempts, 6 * 3600)
+            cursor.execute(sql_outbox_retry, (status, next_attempt, error, outbox_id))
+            logging.error(f'Notification to {chat_id} failed ({attempts}/{max_attempts}): {error}')
+            failed += 1
+            # later messages for this chat wait for the failed one, so they are never delivered out of order
+            cursor.executemany(sql_outbox_defer, [(next_attempt, row[0]) for row in rows[len(chat_results):]])
+    conn.commit()
+    metric_count('notifications_sent', sent)
+    metric_count('notifications_failed', failed)
+    logging.info(f'Notifications dispatched: {sent} sent, {failed} failed.')
+
+def build_message(conn, updates, modified_updates, removed_updates, locale, full_update):
+    cursor = conn.cursor()
+    rules = get_locale_rules(locale)
+    sections = []
     if full_update:
-        update_dates = cursor.execute(sql_get_update_dates).fetchall()
-        for date in update_dates:
-            query = cursor.execute(sql_get_date_updates, date).fetchall()
-            last_updates += query
-        apprise_message = '*Últimas actualizaciones de Apple*\n\n'
+        last_updates = cursor.execute(sql_get_latest_updates, (locale, 5)).fetchall()
+        sections.append((rules['latest_title'], last_updates))
     else:
-        apprise_message = '*Nuevas actualizaciones de Apple*\n\n'
-        last_updates = updates
-    for element in last_updates:
-        date_time = encode_telegram_markdown(element[0])
-        update_product = encode_telegram_markdown(element[1])
-        update_target = encode_telegram_markdown(element[2])
-        update_link = encode_telegram_markdown(element[3])
-        apprise_message += f'_{date_time}_'
-        if update_link is not None:
-            apprise_message += f' \- [{update_product}]({update_link})'
+        sections.append((rules['new_title'], updates))
+        sections.append((rules['modified_title'], modified_updates))
+        sections.append((rules['removed_title'], removed_updates))
+    # rows are rendered by digest_flush at the end of the run, so every chat gets one message per run with the rows of
+    # every locale, or one per digest
+    digest_buffer(cursor, message_selections(cursor, sections, locale), locale)
+
+def message_selections(cursor, sections, locale):
+    rules, product_index, target_index, catch_all = subscriptions_load(cursor)
+    # chats without subscription rules get every row
+    selections = []
+    unfiltered = [chat_id for chat_id in chat_ids if chat_id not in rules]
+    if unfiltered:
+        selections.append((unfiltered, sections))
+    if not rules:
+        return selections
+    matches = {}
+    for number, (title, elements) in enumerate(sections):
+        for position, element in enumerate(elements):
+            for chat_id in subscriptions_match(product_index, target_index, catch_all, element, locale):
+                matches.setdefault(chat_id, []).append((number, position))
+    # chats matching the same rows share one selection
+    shared = {}
+    for chat_id, selection in matches.items():
+        shared.setdefault(tuple(selection), []).append(chat_id)
+    for selection, selection_chat_ids in shared.items():
+        selected = [(title, []) for title, elements in sections]
+        for number, position in selection:
+            selected[number][1].append(sections[number][1][position])
+        selections.append((selection_chat_ids, selected))
+    return selections
+
+def message_parts(header, sections, locale):
+    # deployments watching a single page keep the original message layout, without a locale header
+    parts = [header] if header else []
+    for title, elements in sections:
+        if elements:
+            parts.append(render_title(title))
+            parts += [render_row(localize_row(element, locale), message_format) for element in elements]
+    return parts
+
+def message_chunks(parts):
+    chunks = []
+    chunk = []
+    size = 0
+    for part in parts:
+        if size + len(part) > telegram_message_limit and size > 0:
+            chunks.append(''.join(chunk))
+            chunk = []
+            size = 0
+        chunk.append(part)
+        size += len(part)
+    chunks.append(''.join(chunk))
+    return chunks
+
+def localize_row(element, locale):
+    if element[0] != preinstalled_date:
+        return tuple(element)
+    return (get_locale_rules(locale)['preinstalled'], *element[1:])
+
+def render_title(title):
+    rules = message_formats[message_format]
+    return rules['title'].format(title.translate(rules['escape']))
+
+@lru_cache(maxsize=4096)
+def render_row(element, row_format):
+    rules = message_formats[row_format]
+    update_date, update_product, update_target, update_link = element
+    escape = rules['escape']
+    date_time = rules['date'].format(update_date.translate(escape))
+    if update_link is not None:
+        update_product = rules['link'].format(update_product.translate(escape),
+                                              update_link.translate(rules['link_escape']))
+    else:
+        update_product = rules['product'].format(update_product.translate(escape))
+    separator = rules['separator']
+    return f'{date_time}{separator}{update_product}{separator}{update_target.translate(escape)}\n\n'
+
+@lru_cache(maxsize=4096)
+def text_tokens(text):
+    return frozenset(rule_token.findall(text.lower())) if text else frozenset()
+
+def subscriptions_load(cursor):
+    global subscription_index
+    version = cursor.execute(sql_subscriptions_version).fetchone()
+    if subscription_index[0] != version:
+        subscription_index = (version, subscriptions_compile(cursor.execute(sql_get_subscriptions).fetchall()))
+    return subscription_index[1]
+
+def subscriptions_compile(subscriptions):
+    # every rule is indexed by one of its words, so a row is only tested against rules sharing a word with it
+    rules = set()
+    product_index = {}
+    target_index = {}
+    catch_all = []
+    for chat_id, product_pattern, target_pattern, min_date, cves_only, locale in subscriptions:
+        rule = (chat_id, text_tokens(product_pattern), text_tokens(target_pattern), min_date, cves_only, locale)
+        rules.add(chat_id)
+        # the longest word is usually the least common one, like 'sonoma' in 'macOS Sonoma'
+        if rule[1]:
+            product_index.setdefault(max(rule[1], key=len), []).append(rule)
+        elif rule[2]:
+            target_index.setdefault(max(rule[2], key=len), []).append(rule)
         else:
-            apprise_message += f' \- _{update_product}_'
-        apprise_message += f' \- {update_target}\n\n'
-    return apprise_message
+            catch_all.append(rule)
+    return rules, product_index, target_index, catch_all
+
+def subscriptions_match(product_index, target_index, catch_all, element, locale):
+    update_date, update_product, update_target, update_link = element
+    product_tokens = text_tokens(update_product)
+    target_tokens = text_tokens(update_target)
+    candidates = list(catch_all)
+    for token in product_tokens:
+        candidates += product_index.get(token, [])
+    for token in target_tokens:
+        candidates += target_index.get(token, [])
+    matched = set()
+    for chat_id, rule_product, rule_target, min_date, cves_only, rule_locale in candidates:
+        if chat_id in matched or not rule_product <= product_tokens or not rule_target <= target_tokens:
+            continue
+        if min_date is not None and update_date != preinstalled_date and update_date < min_date:
+            continue
+        # Apple only links rows with published CVE entries
+        if cves_only and update_link is None:
+            continue
+        if rule_locale is not None and rule_locale != locale:
+            continue
+        matched.add(chat_id)
+    return matched
+
+def check_iso_date(value):
+    # dates are compared as text with the stored ones, so only the YYYY-MM-DD form of a real date is accepted
+    if not re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        raise ValueError(f"Invalid date format: {value}")
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+
+def subscription_add(conn, chat_id, product_pattern, target_pattern, min_date, cves_only, locale):
+    if min_date is not None:
+        check_iso_date(min_date)
+    conn.cursor().execute(sql_subscriptions_table, (chat_id, product_pattern, target_pattern, min_date,
+                                                    int(cves_only), locale))
+    conn.commit()
+    logging.info(f'Subscription added for {chat_id}.')
+
+def subscription_remove(conn, chat_id):
+    conn.cursor().execute(sql_delete_subscriptions, (chat_id,))
+    conn.commit()
+    logging.info(f'Subscriptions removed for {chat_id}.')
+
+def archive_extract(content, page_url):
+    soup = html_soup(content)
+    table = soup.find('div', id="tableWraper")
+    content_updates = table.find_all('tr') if table is not None else []
+    host = urlsplit(page_url).netloc
+    archive_urls = []
+    for anchor in soup.find_all('a', href=True):
+        # rows of the table link to advisories, archive pages are linked from the text around it
+        if anchor.find_parent('div', id="tableWraper") is not None or not archive_year.search(anchor.get_text()):
+            continue
+        url = urljoin(page_url, anchor['href']).split('#')[0].split('?')[0]
+        if urlsplit(url).netloc == host and archive_link.search(urlsplit(url).path) and url not in archive_urls:
+            archive_urls.append(url)
+    return content_updates, archive_urls
+
+def pages_stream(pending):
+    # yields responses as they arrive, with at most fetch_workers requests in flight; (url, headers) pairs appended to
+    # pending while iterating are fetched too
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    with ThreadPoolExecutor(max_workers=max(1, fetch_workers)) as pool:
+        running = {}
+        while pending or running:
+            while pending and len(running) < max(1, fetch_workers):
+                url, headers = pending.popleft()
+                running[pool.submit(page_fetch, url, headers)] = url
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future.result()
+
+def archive_store(cursor, content_updates, file_hash, locale):
+    # pages list rows newest first, they are stored oldest first like the rows of HT201222
+    rows = reversed(list(updates_rows(content_updates, locale)))
+    stored = 0
+    while batch := list(itertools.islice(rows, backfill_batch_size)):
+        cursor.executemany(sql_updates_table, [(*element, file_hash, locale) for element in batch])
+        stored += cursor.rowcount
+    return stored
+
+def backfill(conn):
+    for url in apple_urls:
+        backfill_locale(conn, url, url_locale(url))
+
+def backfill_locale(conn, url, locale):
+    cursor = conn.cursor()
+    response = page_fetch(url, {})
+    if response is None:
+        return
+    content_updates, archive_urls = archive_extract(response.content, url)
+    cursor.executemany(sql_backfill_table, [(archive_url, locale) for archive_url in archive_urls])
+    conn.commit()
+    # archive pages already stored are skipped, so an interrupted backfill resumes where it stopped
+    archive_pages = dict(cursor.execute(sql_get_backfill, (locale,)).fetchall())
+    pending = collections.deque((page, {}) for page, status in archive_pages.items() if status == 'pending')
+    seen = set(archive_pages) | {url}
+    logging.info(f'Backfill started, {len(pending)} of {len(archive_pages)} archive pages pending - {locale}.')
+    pages = rows = 0
+    for page_url, response in pages_stream(pending):
+        if response is None:
+            continue
+        if response.status_code != 200:
+            logging.error(f'Error fetching archive page {page_url}: HTTP {response.status_code}')
+            continue
+        file_hash = hashlib.sha256(response.content).hexdigest()
+        snapshot_save(snapshot_dir, file_hash, response.content)
+        try:
+            with metric_span('parse'):
+                content_updates, archive_urls = archive_extract(response.content, page_url)
+            # rows, newly found archive pages and the page status are committed together
+            with metric_span('db_write'):
+                stored = archive_store(cursor, content_updates, file_hash, locale)
+                new_urls = [archive_url for archive_url in archive_urls if archive_url not in seen]
+                cursor.executemany(sql_backfill_table, [(archive_url, locale) for archive_url in new_urls])
+                cursor.execute(sql_backfill_done, (file_hash, stored, page_url, locale))
+                conn.commit()
+        except (Error, ValueError, IndexError, KeyError, AttributeError, TypeError) as error:
+            conn.rollback()
+            logging.error(f'Error storing archive page {page_url}: {error!r}')
+            continue
+        seen.update(new_urls)
+        pending.extend((archive_url, {}) for archive_url in new_urls)
+        pages += 1
+        rows += stored
+        metric_count('backfill_pages')
+        metric_count('backfill_rows', stored)
+        logging.info(f'Archive page {page_url} stored, {stored} new rows - {locale}.')
+    logging.info(f'Backfill finished, {pages} archive pages and {rows} new rows stored - {locale}.')
+
+def advisories_crawl(conn):
+    cursor = conn.cursor()
+    now = time.time()
+    # new links are fetched in full, cached advisories are revalidated with conditional requests once they are older
+    # than advisory_max_age. Runs hold the run lock meanwhile, so each one fetches at most advisories_per_run pages,
+    # newest links first, and a large backlog like the one left by --backfill is drained over several runs
+    advisories = {url: (locale, None, None, None)
+                  for url, locale in cursor.execute(sql_get_new_advisories, (advisories_per_run,))}
+    for url, locale, content_hash, etag, last_modified in cursor.execute(
+            sql_get_stale_advisories, (now - advisory_max_age, advisories_per_run - len(advisories))):
+        advisories[url] = (locale, content_hash, etag, last_modified)
+    if not advisories:
+        return
+    if len(advisories) >= advisories_per_run:
+        logging.info(f'Fetching {len(advisories)} advisories, the rest are left for the next runs.')
+    # links may be relative to the HT201222 page they were found on
+    pages = {url_locale(url): url for url in apple_urls}
+    links = {}
+    pending = collections.deque()
+    for url, (locale, content_hash, etag, last_modified) in advisories.items():
+        headers = {}
+        if content_hash is not None and etag is not None:
+            headers['If-None-Match'] = etag
+        if content_hash is not None and last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        links[urljoin(pages.get(locale, ''), url)] = url
+        pending.append((urljoin(pages.get(locale, ''), url), headers))
+    for link, response in pages_stream(pending):
+        if response is None:
+            continue
+        url = links[link]
+        locale, content_hash = advisories[url][:2]
+        if response.status_code == 304:
+            metric_count('advisories_not_modified')
+            cursor.execute(sql_advisory_fetched, (time.time(), url))
+            conn.commit()
+            continue
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        if response.status_code != 200:
+            # missing advisories are retried after advisory_max_age
+            logging.error(f'Error fetching advisory {url}: HTTP {response.status_code}')
+            cursor.execute(sql_advisories_table, (url, locale, None, None, None, time.time()))
+            conn.commit()
+            continue
+        try:
+            new_hash = hashlib.sha256(response.content).hexdigest()
+            snapshot_write(cache_dir, new_hash, response.content)
+            if new_hash != content_hash:
+                with metric_span('parse'):
+                    cves = advisory_extract(response.content, locale)
+                with metric_span('db_write'):
+                    cursor.execute(sql_delete_cves, (url,))
+                    cursor.executemany(sql_cves_table, [(url, *cve) for cve in cves])
+                metric_count('cves_parsed', len(cves))
+            cursor.execute(sql_advisories_table, (url, locale, new_hash, *validators, time.time()))
+            conn.commit()
+        except (Error, OSError, ValueError) as error:
+            conn.rollback()
+            logging.error(f'Error storing advisory {url}: {error}')
+            continue
+        metric_count('advisories_fetched')
 
-def encode_telegram_markdown(text):
-    if text is None:
+def advisory_extract(content, locale):
+    rules = get_locale_rules(locale)
+    soup = html_soup(content)
+    cves = {}
+    component = impact = description = None
+    # every component is a heading followed by its impact, description and CVE paragraphs
+    for element in soup.find_all(['h3', 'p']):
+        text = element.get_text(' ', strip=True).replace('\xa0', ' ')
+        if element.name == 'h3':
+            component, impact, description = text, None, None
+        elif text.startswith(rules['impact']):
+            impact = text[len(rules['impact']):].strip()
+        elif text.startswith(rules['description']):
+            description = text[len(rules['description']):].strip()
+        else:
+            for cve in cve_id.findall(text):
+                cves.setdefault(cve, (cve, component, impact, description))
+    return list(cves.values())
+
+def replay(conn, replay_file):
+    global replaying
+    if os.path.exists(replay_file):
+        raise FileExistsError(f"Replay database already exists: {replay_file}")
+    target: Connection = create_connection(replay_file)
+    migrate_database(target, url_locale(apple_urls[0]))
+    cursor = target.cursor()
+    replaying = True
+    pages = missing = 0
+    try:
+        # pages are replayed in the order they were first seen, so the diffs match the original runs
+        for publish_date, file_hash, etag, last_modified, locale in conn.execute(sql_get_snapshots).fetchall():
+            content = snapshot_read(snapshot_dir, file_hash)
+            if content is None:
+                missing += 1
+                continue
+            publish_date, content_updates = page_extract(content)
+            check_content(content_updates, publish_date, file_hash, (etag, last_modified), locale, target)
+            pages += 1
+        for url, locale, file_hash in conn.execute(sql_get_backfill_snapshots).fetchall():
+            content = snapshot_read(snapshot_dir, file_hash)
+            if content is None:
+                missing += 1
+                continue
+            content_updates, archive_urls = archive_extract(content, url)
+            stored = archive_store(cursor, content_updates, file_hash, locale)
+            cursor.execute(sql_backfill_table, (url, locale))
+            cursor.execute(sql_backfill_done, (file_hash, stored, url, locale))
+            target.commit()
+            pages += 1
+        for url, locale, content_hash, etag, last_modified, fetched_at in conn.execute(sql_get_advisories).fetchall():
+            content = snapshot_read(cache_dir, content_hash) if content_hash is not None else None
+            if content is not None:
+                cursor.executemany(sql_cves_table, [(url, *cve) for cve in advisory_extract(content, locale)])
+                pages += 1
+            elif content_hash is not None:
+                # without its body the advisory is fetched again by the next run
+                missing += 1
+                continue
+            cursor.execute(sql_advisories_table, (url, locale, content_hash, etag, last_modified, fetched_at))
+        target.commit()
+    finally:
+        replaying = False
+        target.close()
+    logging.info(f'\'{replay_file}\' rebuilt from {pages} snapshots, {missing} snapshots missing.')
+
+def export(conn, export_file, export_format, incremental):
+    export_format = export_format or export_formats.get(os.path.splitext(export_file)[1].lower())
+    if export_format not in export_formats.values():
+        raise ValueError(f"Unknown export format for {export_file}, use --format")
+    cursor = conn.cursor()
+    # incremental exports are keyed by output file, and only write rows added since the previous export to it
+    mark_key = os.path.abspath(export_file)
+    after = 0
+    if incremental:
+        mark = cursor.execute(sql_get_export_mark, (mark_key,)).fetchone()
+        after = mark[0] if mark is not None else 0
+        if cursor.execute(sql_export_pending, (after,)).fetchone()[0] == 0:
+            logging.info(f'No updates to export to \'{export_file}\' after update_id {after}.')
+            return
+        # every increment gets its own file, named after the first update_id it can hold, so a consumer that has not
+        # read the previous one yet never loses it
+        root, extension = os.path.splitext(export_file)
+        export_file = f'{root}-{after + 1:010d}{extension}'
+    writers = {'csv': export_csv, 'jsonl': export_jsonl, 'parquet': export_arrow, 'arrow': export_arrow}
+    # the file is replaced only once complete, and the mark only moves after that
+    count, last_id = writers[export_format](f'{export_file}.tmp', export_batches(conn, after), export_format)
+    os.replace(f'{export_file}.tmp', export_file)
+    if incremental:
+        cursor.execute(sql_export_mark, (mark_key, last_id or after))
+        conn.commit()
+    logging.info(f'{count} updates exported to \'{export_file}\' ({export_format}), after update_id {after}.')
+
+def export_batches(conn, after):
+    cursor = conn.cursor()
+    cursor.execute(sql_export_updates, (after,))
+    while batch := cursor.fetchmany(export_batch_size):
+        yield batch
+
+def export_csv(path, batches, export_format):
+    count, last_id = 0, None
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(export_columns)
+        for batch in batches:
+            writer.writerows(batch)
+            count, last_id = count + len(batch), batch[-1][0]
+    return count, last_id
+
+def export_jsonl(path, batches, export_format):
+    count, last_id = 0, None
+    with open(path, 'w', encoding='utf-8') as file:
+        for batch in batches:
+            file.writelines(json.dumps(dict(zip(export_columns, row)), ensure_ascii=False) + '\n' for row in batch)
+            count, last_id = count + len(batch), batch[-1][0]
+    return count, last_id
+
+def export_arrow(path, batches, export_format):
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError(f"Exporting to {export_format} requires the pyarrow package")
+    schema = pyarrow.schema([('update_id', pyarrow.int64())] + [(column, pyarrow.string())
+                                                                  for column in export_columns[1:]])
+    if export_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pyarrow.ipc.new_file(path, schema)
+    count, last_id = 0, None
+    # every batch becomes a parquet row group or an arrow record batch, never the whole table
+    with writer:
+        for batch in batches:
+            columns = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*batch), schema)]
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+            count, last_id = count + len(batch), batch[-1][0]
+    return count, last_id
+
+def run_lock_stale(host, pid, heartbeat):
+    if heartbeat < time.time() - lock_stale:
+        return True
+    # a holder on this host that is gone can be replaced right away
+    if host == socket.gethostname() and pid != os.getpid():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return False
+
+def run_lock_acquire(conn):
+    # returns the lock owner id, or None when the run coalesced onto another one
+    owner = os.urandom(8).hex()
+    waited_for = None
+    deadline = time.monotonic() + lock_wait
+    while True:
+        if conn.in_transaction:
+            conn.commit()
+        # BEGIN IMMEDIATE takes the database write lock, so only one process can check and take the run lock
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(sql_get_run_lock).fetchone()
+        stale = row is not None and row[4] is None and run_lock_stale(*row[1:4])
+        active = row is not None and row[4] is None and not stale
+        if waited_for is not None and not stale and not (active and row[0] == waited_for):
+            conn.commit()
+            # the run we waited for has finished, its rows and notifications are already in the database
+            result = row[5] if row is not None and row[0] == waited_for else None
+            logging.info(f'Run coalesced onto run {waited_for}, result: {result}.')
+            metric_count('runs_coalesced')
+            return None
+        if not active:
+            if stale:
+                logging.warning(f'Stale run lock of {row[1]} (pid {row[2]}) taken over.')
+                metric_count('stale_locks')
+            now = time.time()
+            conn.execute(sql_run_lock_acquire, (owner, socket.gethostname(), os.getpid(), now, now))
+            conn.commit()
+            return owner
+        conn.commit()
+        if waited_for is None:
+            waited_for = row[0]
+            logging.info(f'Run {waited_for} of {row[1]} (pid {row[2]}) in progress, waiting for it.')
+        if time.monotonic() > deadline:
+            logging.warning(f'Run {waited_for} still in progress after {lock_wait}s, skipping this run.')
+            metric_count('runs_skipped')
+            return None
+        time.sleep(1)
+
+def run_lock_heartbeat(owner, stop):
+    # slow runs keep their lock fresh from a separate connection, so they are never taken for stale
+    conn: Connection = create_connection(db_file)
+    while not stop.wait(lock_stale / 3):
+        try:
+            conn.execute(sql_run_lock_heartbeat, (time.time(), owner))
+            conn.commit()
+        except Error as error:
+            logging.error(f'Error refreshing run lock: {error}')
+    conn.close()
+
+def run_lock_release(conn, owner):
+    # an interrupted run leaves no half written transaction behind
+    if conn.in_transaction:
+        conn.rollback()
+    with metrics_lock:
+        result = json.dumps(run_metrics, sort_keys=True)
+    conn.execute(sql_run_lock_release, (time.time(), result, owner))
+    conn.commit()
+
+def run(conn):
+    with metrics_lock:
+        run_metrics.clear()
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    owner = heartbeat_stop = None
+    try:
+        owner = run_lock_acquire(conn)
+        if owner is None:
+            return
+        heartbeat_stop = threading.Event()
+        threading.Thread(target=run_lock_heartbeat, args=(owner, heartbeat_stop), daemon=True).start()
+        pages_scrape(apple_urls, conn)
+        with metric_span('notify'):
+            digest_flush(conn)
+            outbox_dispatch(conn)
+        with metric_span('advisories'):
+            advisories_crawl(conn)
+    finally:
+        if heartbeat_stop is not None:
+            heartbeat_stop.set()
+        duration = time.perf_counter() - start
+        metric_count('run_seconds', duration)
+        if profiler is not None:
+            profiler.disable()
+            if duration >= profile_min_seconds:
+                profiler.dump_stats(profile_file)
+                logging.info(f'Run took {duration:.3f}s, profile saved to \'{profile_file}\'.')
+        if owner is not None:
+            run_lock_release(conn, owner)
+        metrics_export()
+
+def open_database():
+    conn: Connection = create_connection(db_file)
+    migrate_database(conn, url_locale(apple_urls[0]))
+    return conn
+
+def api_open():
+    global api_conn, api_db_file, api_version
+    # a separate read-only connection, in WAL mode readers never wait for the bot writing
+    if api_conn is None or api_db_file != db_file:
+        if api_conn is not None:
+            api_conn.close()
+        api_conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True, check_same_thread=False)
+        api_db_file = db_file
+        api_version = None
+    return api_conn
+
+def api_response(path, params):
+    # returns (status, etag, body), bodies are cached until any connection commits a write
+    global api_version
+    key = (path, tuple(sorted(params.items())))
+    with api_lock:
+        conn = api_open()
+        version = conn.execute(sql_get_data_version).fetchone()[0]
+        if version != api_version:
+            api_cache.clear()
+            api_version = version
+        if key in api_cache:
+            metric_total('api_cache_hits')
+            return api_cache[key]
+        metric_total('api_cache_misses')
+        try:
+            result = api_query(conn, path, params)
+        except ValueError as error:
+            return 400, None, json.dumps({'error': str(error)}).encode('utf-8')
+        if result is None:
+            return 404, None, json.dumps({'error': 'not found'}).encode('utf-8')
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        response = (200, f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+        if len(api_cache) >= api_cache_size:
+            api_cache.clear()
+        api_cache[key] = response
+        return response
+
+def api_query(conn, path, params):
+    for name in ('since', 'until'):
+        if params.get(name) is not None:
+            check_iso_date(params[name])
+    try:
+        limit = min(int(params.get('limit', api_page_size)), api_max_page_size)
+        # keyset pagination on the page order, 'after' is 'update_date,update_id' of the last row of the previous page
+        after_date = after_id = None
+        if params.get('after') is not None:
+            after_date, separator, after_id = params['after'].rpartition(',')
+            if not separator:
+                raise ValueError
+            after_id = int(after_id)
+    except ValueError:
+        raise ValueError("Invalid 'limit' or 'after' value")
+    filters = {'locale': params.get('locale'), 'since': params.get('since'), 'until': params.get('until'),
+               'after_date': after_date, 'after_id': after_id, 'limit': max(1, limit)}
+    if path == '/updates':
+        rows = conn.execute(sql_api_updates, filters).fetchall()
+    elif path == '/search':
+        words = rule_token.findall(params.get('q', '').lower())
+        if not words:
+            raise ValueError("Missing search text 'q'")
+        if conn.execute(sql_check_updates_fts).fetchone()[0]:
+            query = ' '.join(f'"{word}"' for word in words)
+            rows = conn.execute(sql_api_search, {**filters, 'query': query}).fetchall()
+        else:
+            pattern = f"%{params['q'].translate(like_escape)}%"
+            rows = conn.execute(sql_api_search_like, {**filters, 'pattern': pattern}).fetchall()
+    elif path == '/cve':
+        if not cve_id.fullmatch(params.get('id', '').upper()):
+            raise ValueError("Invalid CVE id")
+        rows = conn.execute(sql_api_cve, {**filters, 'cve': params['id'].upper()}).fetchall()
+    else:
         return None
-    reserved_chars = ['%', '&', '#', '?', ' ', '/', '@', '+', ',', ':', '-', '.', '(', ')']
-    replace_chars = ['\%', '\&', '\#', '\?', '\ ', '\/', '\@', '\+', '\,', '\:', '\-', '\.', '\(', '\)']
-    encoded_text = text
-    for char, replace_char in zip(reserved_chars, replace_chars):
-        if encoded_text is not None and char in encoded_text:
-            encoded_text = encoded_text.replace(char, replace_char)
-    return encoded_text
+    links = list({row[4] for row in rows if row[4] is not None})
+    cves = {}
+    if links:
+        for update_link, cve in conn.execute(sql_api_cves.format(', '.join('?' * len(links))), links):
+            cves.setdefault(update_link, []).append(cve)
+    updates = [{'update_id': update_id, 'update_date': update_date, 'update_product': update_product,
+                'update_target': update_target, 'update_link': update_link, 'locale': locale,
+                'cves': cves.get(update_link, [])}
+               for update_id, update_date, update_product, update_target, update_link, locale in rows]
+    return {'updates': updates, 'next': f'{rows[-1][1]},{rows[-1][0]}' if len(rows) == filters['limit'] else None}
+
+def api_server_start(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl
+
+    class ApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            status, etag, body = api_response(url.path.rstrip('/'), dict(parse_qsl(url.query)))
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    api_server = ThreadingHTTPServer(('127.0.0.1', port), ApiHandler)
+    threading.Thread(target=api_server.serve_forever, daemon=True).start()
+    return api_server
+
+def commands_poll(stop):
+    # long polling of Telegram bot commands, answered from the same cached queries as the HTTP API
+    offset = None
+    while not stop.is_set():
+        try:
+            response = session.get(f'https://api.telegram.org/bot{bot_token}/getUpdates',
+                                   params={'offset': offset, 'timeout': 25, 'allowed_updates': '["message"]'},
+                                   timeout=35)
+            telegram_updates = response.json().get('result', [])
+        except (requests.exceptions.RequestException, ValueError) as error:
+            logging.error(f'Error polling bot commands: {error}')
+            stop.wait(30)
+            continue
+        for telegram_update in telegram_updates:
+            offset = telegram_update['update_id'] + 1
+            message = telegram_update.get('message') or {}
+            text = message.get('text', '')
+            if text.startswith('/'):
+                command_answer(str(message.get('chat', {}).get('id')), text)
+
+def command_answer(chat_id, text):
+    with api_lock:
+        subscribers = {row[0] for row in api_open().execute(sql_get_subscribers)}
+    # only chats the bot already notifies may query it
+    if chat_id not in chat_ids and chat_id not in subscribers:
+        return
+    command, _, argument = text.partition(' ')
+    command = command.split('@')[0].lower()
+    argument = argument.strip()
+    # replies are written in the language of the first configured page
+    locale = url_locale(apple_urls[0])
+    rules = get_locale_rules(locale)
+    if command == '/latest':
+        title, path, params = rules['latest_title'], '/updates', {'limit': argument or '10'}
+    elif command == '/search':
+        title, path, params = rules['search_title'].format(argument), '/search', {'q': argument, 'limit': '10'}
+    elif command == '/since':
+        title, path, params = rules['since_title'].format(argument), '/updates', {'since': argument, 'limit': '20'}
+    elif command == '/cve':
+        title, path, params = rules['cve_title'].format(argument.upper()), '/cve', {'id': argument, 'limit': '20'}
+    else:
+        title, path, params = rules['commands_help'], None, {}
+    rows = []
+    if path is not None:
+        status, etag, body = api_response(path, params)
+        result = json.loads(body)
+        if status != 200:
+            title = f'Error: {result["error"]}'
+        else:
+            rows = [localize_row((update['update_date'], update['update_product'], update['update_target'],
+                                  update['update_link']), update['locale']) for update in result['updates']]
+            if not rows:
+                title = f'{title}\n{rules["no_results"]}'
+    chunks = message_chunks(message_parts('', [(title, rows)], locale)) if rows else \
+        [render_title(title)]
+    for chunk in chunks:
+        apprise_send(chat_id, chunk)
+    metric_total('commands_answered')
+
+async def daemon(local_path):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    # sqlite connections are bound to the thread that created them, so every database call runs on one worker
+    worker = ThreadPoolExecutor(max_workers=1)
+    stop = asyncio.Event()
+    reload = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    loop.add_signal_handler(signal.SIGHUP, reload.set)
+
+    conn = await loop.run_in_executor(worker, open_database)
+    metrics_server = None
+    if metrics_port:
+        metrics_server = metrics_server_start(metrics_port)
+        logging.info(f'Metrics available at http://127.0.0.1:{metrics_port}/metrics.')
+    api_server = None
+    if api_port:
+        api_server = api_server_start(api_port)
+        logging.info(f'API available at http://127.0.0.1:{api_port}/updates.')
+    commands_stop = threading.Event()
+    if bot_commands:
+        threading.Thread(target=commands_poll, args=(commands_stop,), daemon=True).start()
+        logging.info('Answering bot commands.')
+    logging.info(f'Daemon started, polling every {poll_interval}s (+{poll_jitter}s jitter).')
+    while not stop.is_set():
+        if reload.is_set():
+            reload.clear()
+            previous_db_file = db_file
+            if config_reload(local_path):
+                if db_file != previous_db_file:
+                    await loop.run_in_executor(worker, conn.close)
+                    conn = await loop.run_in_executor(worker, open_database)
+                logging.info('Configuration reloaded.')
+        try:
+            await loop.run_in_executor(worker, run, conn)
+        except Exception as error:
+            logging.exception(f'Run failed: {error}')
+        delay = poll_interval + random.uniform(0, poll_jitter)
+        # a SIGHUP ends the wait too, so a new config is applied right away instead of after the next poll
+        waits = [asyncio.ensure_future(stop.wait()), asyncio.ensure_future(reload.wait())]
+        await asyncio.wait(waits, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        for task in waits:
+            task.cancel()
+
+    await loop.run_in_executor(worker, conn.close)
+    worker.shutdown()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    if api_server is not None:
+        api_server.shutdown()
+        api_server.server_close()
+    commands_stop.set()
+    logging.info('Daemon stopped.')
+
+def argument_parser():
+    parser = argparse.ArgumentParser(prog='asu-bot',
+                                     description='Checks Apple security updates page and notifies new updates.')
+    parser.add_argument('-d', '--daemon', action='store_true', help='[optional] Keep running and poll the Apple '
+                                                                     'page every "poll_interval" seconds instead of '
+                                                                     'checking once and exiting. Send SIGHUP to '
+                                                                     'reload config.json')
+    parser.add_argument('-b', '--backfill', action='store_true', help='[optional] After checking the Apple page, load '
+                                                                       'the older security releases from its archive '
+                                                                       'pages into the database, without notifying '
+                                                                       'them. Interrupted backfills are resumed')
+    parser.add_argument('-r', '--replay', metavar='DB_FILE', help='[optional] Build a new database in DB_FILE by '
+                                                                    'parsing again every stored snapshot, without '
+                                                                    'network access or notifications')
+    parser.add_argument('-s', '--subscribe', metavar='CHAT_ID', help='[optional] Add a subscription rule for CHAT_ID '
+                                                                       'and exit. The chat only gets the rows matching '
+                                                                       'any of its rules')
+    parser.add_argument('--product', help='[optional] With --subscribe, words that must appear in the product name, '
+                                          'like "macOS Sonoma"')
+    parser.add_argument('--target', help='[optional] With --subscribe, words that must appear in the target, like '
+                                         '"iPhone"')
+    parser.add_argument('--since', metavar='YYYY-MM-DD', help='[optional] With --subscribe, ignore rows older than '
+                                                              'this date')
+    parser.add_argument('--cves-only', action='store_true', help='[optional] With --subscribe, only rows with '
+                                                                 'published CVE entries')
+    parser.add_argument('--locale', help='[optional] With --subscribe, only rows of this locale, like "es-cl"')
+    parser.add_argument('-u', '--unsubscribe', metavar='CHAT_ID', help='[optional] Remove every subscription rule of '
+                                                                         'CHAT_ID and exit')
+    parser.add_argument('--schedule', metavar='CHAT_ID', help='[optional] Set when CHAT_ID is notified and exit')
+    parser.add_argument('--tz', help='[optional] With --schedule, timezone of the chat, like "America/Santiago"')
+    parser.add_argument('--digest-at', metavar='HH:MM', nargs='*', help='[optional] With --schedule, local times '
+                                                                        'when buffered rows are sent as one digest. '
+                                                                        'Without times, rows are sent right away')
+    parser.add_argument('--digest-size', metavar='ROWS', type=int, help='[optional] With --schedule, send the digest '
+                                                                        'earlier once it holds this many rows')
+    parser.add_argument('--quiet', metavar='HH:MM-HH:MM', help='[optional] With --schedule, local hours without '
+                                                                'notifications, like "22:00-07:00". An empty value '
+                                                                'turns them off')
+    parser.add_argument('-e', '--export', metavar='FILE', help='[optional] Export the updates table to FILE and exit. '
+                                                                 'The format is taken from its extension: .csv, '
+                                                                 '.jsonl, .parquet or .arrow (Parquet and Arrow need '
+                                                                 'pyarrow)')
+    parser.add_argument('--format', choices=sorted(set(export_formats.values())),
+                        help='[optional] With --export, format of FILE when its extension is not one of the above')
+    parser.add_argument('--incremental', action='store_true', help='[optional] With --export, only write the updates '
+                                                                   'added since the previous export to the same FILE')
+    parser.add_argument('-p', '--profile', metavar='FILE', help='[optional] Profile runs with cProfile and save the '
+                                                                 'stats to FILE')
+    parser.add_argument('--profile-min', metavar='SECONDS', type=float, default=0.0,
+                        help='[optional] Only save profiles of runs lasting at least SECONDS')
+    return parser.parse_args()
 
 def main():
+    global profile_file, profile_min_seconds
+    args = argument_parser()
+    profile_file = args.profile
+    profile_min_seconds = args.profile_min
     local_file = __file__
     local_path = os.path.dirname(local_file)
     get_config(local_path)
@@ -215,9 +1936,35 @@ def main():
     log_format = '%(asctime)s -- %(message)s'
     logging.basicConfig(filename=log_file, encoding='utf-8', format=log_format, level=logging.INFO)
 
-    conn: Connection = create_connection(db_file)
+    if args.daemon:
+        import asyncio
+        asyncio.run(daemon(local_path))
+        return
 
-    page_scrape(apple_url, conn)
+    conn = open_database()
+    if args.schedule:
+        schedule_set(conn, args.schedule, args.tz, args.digest_at, args.digest_size, args.quiet)
+        conn.close()
+        return
+    if args.subscribe or args.unsubscribe:
+        if args.subscribe:
+            subscription_add(conn, args.subscribe, args.product, args.target, args.since, args.cves_only, args.locale)
+        else:
+            subscription_remove(conn, args.unsubscribe)
+        conn.close()
+        return
+    if args.export:
+        export(conn, args.export, args.format, args.incremental)
+        conn.close()
+        return
+    if args.replay:
+        replay(conn, args.replay)
+        conn.close()
+        return
+    run(conn)
+    if args.backfill:
+        backfill(conn)
+    conn.close()
 
 if __name__ == '__main__':
     main()
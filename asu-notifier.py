@@ -6,7 +6,6 @@
 # the associated database, and sets a cronjob which will run the secondary component of ASU Notifier hourly.
 
 import argparse
-import contextlib
 import json
 import logging
 import os
@@ -25,11 +24,6 @@ from crontab import CronTab
 
 # SQL queries
 sql_check_empty_database: str = """ SELECT COUNT(name) FROM sqlite_master WHERE type='table' AND name='main' """
-sql_create_main_table: str = """CREATE TABLE IF NOT EXISTS main ( main_id integer PRIMARY KEY AUTOINCREMENT, publish_date 
-text NOT NULL, file_hash text NOT NULL, log_message text NOT NULL );"""
-sql_create_updates_table: str = """CREATE TABLE IF NOT EXISTS updates ( update_id integer PRIMARY KEY AUTOINCREMENT, 
-update_date text NOT NULL, update_product text NOT NULL, update_target text NOT NULL, update_link text, 
-file_hash text NOT NULL );"""
 
 timezones_list = pytz.all_timezones
 
@@ -45,15 +39,6 @@ def create_connection(file):
     return conn
 
 
-def create_table(conn, sql_create_table, table_name, file):
-    with contextlib.suppress(Error):
-        try:
-            conn.cursor().execute(sql_create_table)
-            logging.info(f'\'{file}\' - \'{table_name}\' table created.')
-        except Error as error:
-            logging.error(str(error))
-
-
 def get_config(local_path):
     config = open(f'{local_path}/asu-notifier.json', 'r')
     data = json.loads(config.read())
@@ -284,11 +269,15 @@ def main():
     conn: Connection = create_connection(db_file)
     cursor = conn.cursor()
     empty_database = cursor.execute(sql_check_empty_database).fetchone()[0] == 0
+    conn.close()
     if empty_database:
-        # create database tables and populate them
-        create_table(conn, sql_create_main_table, 'main', db_file)
-        create_table(conn, sql_create_updates_table, 'updates', db_file)
-        subprocess.run(['python', 'asu-bot.py'], capture_output=True, text=True)
+        # asu-bot.py owns the schema, its migrations create the database tables before populating them
+        result = subprocess.run(['python', 'asu-bot.py'], capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error(f'\'{db_file}\' - database initialization failed: {result.stderr.strip()}')
+            print(f'Database initialization failed, check \'{log_file}\' for details.')
+            exit(1)
+        logging.info(f'\'{db_file}\' - database initialized.')
 
     crontab_job(local_path)
 
@@ -0,0 +1,74 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('bs4')
+pytest.importorskip('pytz')
+
+local_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Response:
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def build_page(rows, publish_date='2024-05-13'):
+    html_rows = []
+    for date_str, product, target, link in rows:
+        product_cell = f'<a href="{link}">{product}</a>' if link else product
+        html_rows.append(f'<tr><td>{product_cell}</td><td>{target}</td><td>{date_str}</td></tr>')
+    return f"""<!DOCTYPE html>
+<html><body><div id="tableWraper"><table><tr><th>Name</th><th>Available for</th><th>Release date</th></tr>
+{''.join(html_rows)}</table></div>
+<div class="mod-date"><time datetime="{publish_date}">{publish_date}</time></div></body></html>""".encode('utf-8')
+
+
+def write_config(directory, **values):
+    config = {
+        'apple_url': 'https://support.apple.com/es-cl/HT201222',
+        'db_file': f'{directory}/asu-notifier.db',
+        'log_file': f'{directory}/asu-notifier.log',
+        'timezone': 'UTC',
+        'bot_token': '123456789:test',
+        'chat_ids': ['-1001'],
+        **values,
+    }
+    with open(f'{directory}/config.json', 'w') as file:
+        json.dump(config, file)
+
+
+@pytest.fixture
+def bot():
+    # every test gets its own copy of the module, with its own globals
+    spec = importlib.util.spec_from_file_location('asu_bot', f'{local_path}/asu-bot.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.sent = []
+    module.apprise_send = lambda chat_id, apprise_message: module.sent.append((chat_id, apprise_message))
+    return module
+
+
+@pytest.fixture
+def configure(bot, tmp_path):
+    connections = []
+
+    def configure(**values):
+        write_config(tmp_path, **values)
+        bot.get_config(str(tmp_path))
+        connections.append(bot.open_database())
+        return connections[-1]
+
+    yield configure
+    for conn in connections:
+        conn.close()
+
+
+@pytest.fixture
+def conn(configure):
+    return configure()
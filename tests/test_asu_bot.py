@@ -0,0 +1,379 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import threading
+import time
+
+import pytest
+
+from conftest import Response, build_page, write_config
+
+es_rows = [('13 de mayo de 2024', 'iOS 17.5 y iPadOS 17.5', 'iPhone XS y posteriores', None),
+           ('13 de mayo de 2024', 'macOS Sonoma 14.5', 'macOS Sonoma', None)]
+en_rows = [('May 13, 2024', 'iOS 17.5 and iPadOS 17.5', 'iPhone XS and later', None),
+           ('Preinstalled', 'iOS 17', 'iPhone 15', None)]
+archive_rows = [('24 de enero de 2023', 'iOS 16.3', 'iPhone 8 y posteriores', None),
+                ('13 de diciembre de 2022', 'iOS 16.2', 'iPhone 8 y posteriores', None)]
+locales_config = {'apple_url': ['https://support.apple.com/es-cl/HT201222', 'https://support.apple.com/en-us/HT201222']}
+
+
+def serve(bot, monkeypatch, pages):
+    monkeypatch.setattr(bot, 'page_fetch', lambda url, headers: pages[bot.url_locale(url)])
+
+
+def api_get(bot, path, params):
+    status, etag, body = bot.api_response(path, params)
+    return status, json.loads(body)
+
+
+def test_not_modified_page_is_not_downloaded_again(bot, conn, monkeypatch):
+    bot.page_scrape('es-cl', Response(build_page(es_rows), headers={'ETag': '"1"', 'Last-Modified': 'Mon, 13 May'}),
+                    conn)
+    requests = []
+
+    def page_fetch(url, headers):
+        requests.append(headers)
+        return Response(b'', status_code=304)
+
+    monkeypatch.setattr(bot, 'page_fetch', page_fetch)
+    bot.pages_scrape(bot.apple_urls, conn)
+    assert requests == [{'If-None-Match': '"1"', 'If-Modified-Since': 'Mon, 13 May'}]
+    assert bot.run_metrics['not_modified'] == 1
+    assert conn.execute('SELECT COUNT(*), etag FROM main').fetchone() == (1, '"1"')
+
+
+def test_unchanged_page_is_not_parsed(bot, conn, monkeypatch):
+    content = build_page(es_rows)
+    bot.page_scrape('es-cl', Response(content, headers={'ETag': '"1"'}), conn)
+
+    def page_extract(content):
+        raise AssertionError('unchanged page parsed')
+
+    monkeypatch.setattr(bot, 'page_extract', page_extract)
+    bot.page_scrape('es-cl', Response(content, headers={'ETag': '"2"'}), conn)
+    assert conn.execute('SELECT COUNT(*), etag FROM main').fetchone() == (1, '"2"')
+    assert bot.run_metrics['unchanged'] == 1
+
+def test_edited_page_updates_the_row_of_its_publish_date(bot, conn):
+    bot.page_scrape('es-cl', Response(build_page(es_rows)), conn)
+    bot.page_scrape('es-cl', Response(build_page(es_rows[:1]), headers={'ETag': '"2"'}), conn)
+    assert conn.execute('SELECT COUNT(*), etag FROM main').fetchone() == (1, '"2"')
+    bot.page_scrape('es-cl', Response(build_page(es_rows[:1], '2024-05-20')), conn)
+    assert conn.execute('SELECT COUNT(*) FROM main').fetchone() == (2,)
+
+
+def test_repeated_rows_are_not_reported_as_modified(bot, conn):
+    repeated = [(*es_rows[0][:3], 'https://support.apple.com/es-cl/120905'),
+                (*es_rows[0][:3], 'https://support.apple.com/es-cl/120906')]
+    bot.page_scrape('es-cl', Response(build_page(repeated)), conn)
+    bot.page_scrape('es-cl', Response(build_page(repeated + es_rows[1:])), conn)
+    bot.run_metrics.clear()
+    bot.page_scrape('es-cl', Response(build_page(repeated + es_rows[1:] + archive_rows[:1])), conn)
+    assert bot.run_metrics['new_rows'] == 1
+    assert bot.run_metrics['modified_rows'] == 0
+
+
+def test_repeated_rows_are_all_stored_and_notified(bot, conn):
+    bot.page_scrape('es-cl', Response(build_page(es_rows[1:])), conn)
+    repeated = [('20 de mayo de 2024', 'Safari 17.5', 'macOS Ventura', '/1'),
+                ('20 de mayo de 2024', 'Safari 17.5', 'macOS Ventura', '/2')]
+    bot.page_scrape('es-cl', Response(build_page(repeated + es_rows[1:], '2024-05-20')), conn)
+    stored = conn.execute("SELECT update_link FROM updates WHERE update_product = 'Safari 17.5' ORDER BY update_link")
+    assert stored.fetchall() == [('/1',), ('/2',)]
+    notified = conn.execute("SELECT update_link FROM digest_rows WHERE title = 'Nuevas actualizaciones de Apple' "
+                            "ORDER BY update_link")
+    assert notified.fetchall() == [('/1',), ('/2',)]
+    bot.run_metrics.clear()
+    bot.page_scrape('es-cl', Response(build_page(repeated + es_rows[1:], '2024-05-21')), conn)
+    assert (bot.run_metrics['new_rows'], bot.run_metrics['modified_rows']) == (0, 0)
+
+
+def test_rows_moved_to_the_archive_are_not_reported_as_withdrawn(bot, conn):
+    bot.page_scrape('es-cl', Response(build_page(es_rows + archive_rows)), conn)
+    bot.run_metrics.clear()
+    bot.page_scrape('es-cl', Response(build_page(es_rows[:1] + archive_rows[:1], '2024-05-20')), conn)
+    assert (bot.run_metrics['removed_rows'], bot.run_metrics['archived_rows']) == (1, 1)
+    withdrawn = conn.execute('SELECT update_product FROM digest_rows WHERE title = ?',
+                             ('Actualizaciones de Apple retiradas',))
+    assert withdrawn.fetchall() == [('macOS Sonoma 14.5',)]
+    assert conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone() == (2,)
+
+
+@pytest.mark.parametrize('values', [{'message_format': 'rtf'}, {'quiet_hours': '25:00-07:00'},
+                                    {'apple_url': 'https://support.apple.com/fr-fr/HT201222'}, None])
+def test_failed_reload_keeps_previous_config(bot, conn, tmp_path, values):
+    write_config(tmp_path, db_file=f'{tmp_path}/other.db', **(values or {}))
+    if values is None:
+        # a config.json saved halfway
+        with open(f'{tmp_path}/config.json', 'w') as file:
+            file.write('{"apple_url": ')
+    previous_db_file = bot.db_file
+    assert not bot.config_reload(str(tmp_path))
+    assert bot.db_file == previous_db_file
+    assert bot.message_format == 'markdown'
+    assert bot.apple_urls == ['https://support.apple.com/es-cl/HT201222']
+
+
+def test_reload_wakes_the_daemon(bot, configure, tmp_path, monkeypatch):
+    configure(poll_interval=3600, poll_jitter=0)
+    runs = []
+
+    def run(conn):
+        runs.append(bot.message_format)
+        if len(runs) == 1:
+            write_config(tmp_path, poll_interval=3600, poll_jitter=0, message_format='text')
+            # sent once the daemon is waiting for the next poll
+            threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGHUP)).start()
+        else:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(bot, 'run', run)
+    asyncio.run(asyncio.wait_for(bot.daemon(str(tmp_path)), 10))
+    assert runs == ['markdown', 'text']
+
+
+def test_failing_locale_does_not_stop_the_others(bot, configure, monkeypatch):
+    conn = configure(**locales_config)
+    serve(bot, monkeypatch, {'es-cl': Response(build_page(es_rows)), 'en-us': Response(b'<html></html>')})
+    bot.run(conn)
+    assert conn.execute('SELECT locale, COUNT(*) FROM updates GROUP BY locale').fetchall() == [('es-cl', 2)]
+    assert bot.run_metrics['scrape_errors'] == 1
+    assert len(bot.sent) == 1
+
+
+def test_missing_attributes_do_not_stop_the_run(bot, configure, monkeypatch):
+    conn = configure(**locales_config)
+    # a link without href is stored without link, a publish date without datetime fails its locale only
+    es_page = build_page([(*es_rows[0][:3], 'removed'), *es_rows[1:]]).replace(b' href="removed"', b'')
+    en_page = build_page(en_rows).replace(b'<time datetime="2024-05-13">', b'<time>')
+    serve(bot, monkeypatch, {'es-cl': Response(es_page), 'en-us': Response(en_page)})
+    bot.run(conn)
+    assert conn.execute('SELECT locale, update_link FROM updates').fetchall() == [('es-cl', None), ('es-cl', None)]
+    assert bot.run_metrics['scrape_errors'] == 1
+    assert len(bot.sent) == 1
+
+
+def test_failing_archive_page_does_not_stop_the_backfill(bot, conn, monkeypatch):
+    links = b'<p><a href="/es-cl/HT213407">2023</a> <a href="/es-cl/HT212146">2022</a></p></body>'
+    pages = {'https://support.apple.com/es-cl/HT201222': build_page(es_rows).replace(b'</body>', links),
+             'https://support.apple.com/es-cl/HT213407':
+                 build_page([(*archive_rows[0][:3], 'removed')]).replace(b' href="removed"', b''),
+             # a row without its date column
+             'https://support.apple.com/es-cl/HT212146':
+                 build_page(archive_rows[1:]).replace(b'<td>13 de', b'<th>13 de')}
+    monkeypatch.setattr(bot, 'page_fetch', lambda url, headers: Response(pages[url]))
+    bot.backfill(conn)
+    assert conn.execute('SELECT url, status FROM backfill ORDER BY url').fetchall() == [
+        ('https://support.apple.com/es-cl/HT212146', 'pending'), ('https://support.apple.com/es-cl/HT213407', 'done')]
+    assert conn.execute('SELECT update_product, update_link FROM updates').fetchall() == [('iOS 16.3', None)]
+
+
+def test_preinstalled_rows_share_one_date(bot, configure, monkeypatch):
+    conn = configure(**locales_config, message_format='text')
+    serve(bot, monkeypatch, {'es-cl': Response(build_page(es_rows + [('Preinstalado', 'iOS 17', 'iPhone 15', None)])),
+                             'en-us': Response(build_page(en_rows))})
+    bot.run(conn)
+    dates = conn.execute("SELECT DISTINCT update_date FROM updates WHERE update_product = 'iOS 17'").fetchall()
+    assert dates == [(bot.preinstalled_date,)]
+    # one message per chat and run, with the rows and titles of every locale
+    [(chat_id, apprise_message)] = bot.sent
+    assert 'Últimas actualizaciones de Apple' in apprise_message and 'Latest Apple updates' in apprise_message
+    assert 'Preinstalado - iOS 17' in apprise_message and 'Preinstalled - iOS 17' in apprise_message
+
+
+def test_failed_notifications_are_retried_in_order(bot, conn, monkeypatch):
+    bot.outbox_enqueue(conn.cursor(), [(['-1001'], ['first', 'second'])])
+    conn.commit()
+    monkeypatch.setattr(bot, 'apprise_send', lambda chat_id, apprise_message: 'not delivered')
+    now = time.time()
+    bot.outbox_dispatch(conn)
+    rows = conn.execute('SELECT message, status, attempts, next_attempt FROM outbox ORDER BY outbox_id').fetchall()
+    assert [row[:3] for row in rows] == [('first', 'pending', 1), ('second', 'pending', 0)]
+    # the first retry waits two minutes, and the later message waits for it
+    assert 120 <= rows[0][3] - now < 130 and rows[1][3] == rows[0][3]
+    monkeypatch.setattr(bot, 'apprise_send', lambda chat_id, apprise_message: bot.sent.append(apprise_message))
+    bot.outbox_dispatch(conn)
+    assert bot.sent == []
+    conn.execute('UPDATE outbox SET next_attempt = 0')
+    bot.outbox_dispatch(conn)
+    assert bot.sent == ['first', 'second']
+    assert conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'sent'").fetchone() == (2,)
+
+
+def test_notifications_fail_after_max_attempts(bot, conn, monkeypatch):
+    bot.max_attempts = 2
+    bot.outbox_enqueue(conn.cursor(), [(['-1001'], ['first'])])
+    monkeypatch.setattr(bot, 'apprise_send', lambda chat_id, apprise_message: 'not delivered')
+    for attempt in range(3):
+        conn.execute('UPDATE outbox SET next_attempt = 0')
+        bot.outbox_dispatch(conn)
+    assert conn.execute('SELECT status, attempts FROM outbox').fetchone() == ('failed', 2)
+    assert bot.run_metrics['notifications_failed'] == 2
+
+
+def test_text_format_escapes_markup(bot):
+    row = bot.render_row(('2024-05-13', 'AT&T <Carrier>', 'iPhone', 'https://example.com/?a=1&b=2'), 'text')
+    assert row == '2024-05-13 - AT&amp;T &lt;Carrier&gt; (https://example.com/?a=1&amp;b=2) - iPhone\n\n'
+
+
+def test_long_notifications_are_split_between_rows(bot, conn):
+    rows = [('13 de mayo de 2024', f'macOS Sonoma 14.5 ({number})', 'Mac ' * 20, f'/{number}') for number in range(200)]
+    bot.page_scrape('es-cl', Response(build_page(rows)), conn)
+    bot.digest_flush(conn)
+    messages = [row[0] for row in conn.execute('SELECT message FROM outbox ORDER BY outbox_id')]
+    assert len(messages) > 1
+    assert all(len(message) <= bot.telegram_message_limit for message in messages)
+    # every chunk ends at a row boundary, and no row is lost
+    assert all(message.endswith('\n\n') for message in messages)
+    assert sum(message.count('macOS Sonoma 14\\.5') for message in messages) == 200
+
+
+def test_backfilled_rows_sort_by_update_date(bot, conn):
+    bot.page_scrape('es-cl', Response(build_page(es_rows)), conn)
+    content_updates, archive_urls = bot.archive_extract(build_page(archive_rows),
+                                                        'https://support.apple.com/es-cl/HT213407')
+    bot.archive_store(conn.cursor(), content_updates, 'archive', 'es-cl')
+    conn.commit()
+    archived = conn.execute("SELECT update_date FROM updates WHERE file_hash = 'archive' ORDER BY update_id")
+    assert archived.fetchall() == [('2022-12-13',), ('2023-01-24',)]
+    latest = conn.execute(bot.sql_get_latest_updates, ('es-cl', 1)).fetchall()
+    assert [row[1] for row in latest] == ['iOS 17.5 y iPadOS 17.5', 'macOS Sonoma 14.5']
+
+    status, result = api_get(bot, '/updates', {'limit': '3'})
+    assert [update['update_date'] for update in result['updates']] == ['2024-05-13', '2024-05-13', '2023-01-24']
+    status, result = api_get(bot, '/updates', {'limit': '3', 'after': result['next']})
+    assert [update['update_date'] for update in result['updates']] == ['2022-12-13']
+    assert result['next'] is None
+
+
+def test_advisories_are_fetched_in_batches(bot, configure, monkeypatch):
+    conn = configure(advisories_per_run=2)
+    rows = [(*es_rows[0][:3], f'/es-cl/{number}') for number in (120903, 120902, 120901)]
+    bot.page_scrape('es-cl', Response(build_page(rows)), conn)
+    fetched = []
+
+    def page_fetch(url, headers):
+        fetched.append(url.rsplit('/', 1)[1])
+        return Response(b'<html><body><h3>Kernel</h3><p>CVE-2024-23225</p></body></html>')
+
+    monkeypatch.setattr(bot, 'page_fetch', page_fetch)
+    bot.advisories_crawl(conn)
+    # the rows of a page are stored oldest first, the newest links are fetched first
+    assert sorted(fetched) == ['120902', '120903']
+    bot.advisories_crawl(conn)
+    assert sorted(fetched) == ['120901', '120902', '120903']
+    assert conn.execute('SELECT COUNT(*) FROM cves').fetchone() == (3,)
+
+
+def test_subscriptions_select_rows_per_chat(bot, conn):
+    bot.subscription_add(conn, '-2001', 'macOS Sonoma', None, None, False, None)
+    bot.subscription_add(conn, '-2002', None, 'iPhone', None, False, None)
+    bot.subscription_add(conn, '-2003', None, None, None, True, None)
+    bot.subscription_add(conn, '-2004', None, None, '2024-05-14', False, None)
+    bot.subscription_add(conn, '-2005', None, None, None, False, 'en-us')
+    rules, product_index, target_index, catch_all = bot.subscriptions_load(conn.cursor())
+    # rules are indexed by their longest word
+    assert (list(product_index), list(target_index), len(catch_all)) == (['sonoma'], ['iphone'], 3)
+    rows = [(*es_rows[0][:3], '/es-cl/120903'), es_rows[1], ('Preinstalado', 'iOS 17', 'iPhone 15', None)]
+    bot.page_scrape('es-cl', Response(build_page(rows)), conn)
+    selected = {}
+    for chat_id, update_product in conn.execute('SELECT chat_id, update_product FROM digest_rows ORDER BY digest_id'):
+        selected.setdefault(chat_id, []).append(update_product)
+    assert selected == {'-1001': ['iOS 17.5 y iPadOS 17.5', 'macOS Sonoma 14.5', 'iOS 17'],
+                        '-2001': ['macOS Sonoma 14.5'],
+                        '-2002': ['iOS 17.5 y iPadOS 17.5', 'iOS 17'],
+                        '-2003': ['iOS 17.5 y iPadOS 17.5'],
+                        '-2004': ['iOS 17']}
+
+
+def test_api_validates_dates_and_escapes_like(bot, conn, monkeypatch):
+    bot.page_scrape('es-cl', Response(build_page(es_rows + [('1 de mayo de 2024', 'Safari 100%', 'macOS', None)])),
+                    conn)
+    assert api_get(bot, '/updates', {'since': '2024-13-99'})[0] == 400
+    assert api_get(bot, '/updates', {'since': '20240501'})[0] == 400
+    status, result = api_get(bot, '/updates', {'since': '2024-05-02'})
+    assert len(result['updates']) == 2
+    monkeypatch.setattr(bot, 'sql_check_updates_fts', """ SELECT 0; """)
+    assert [update['update_product'] for update in api_get(bot, '/search', {'q': '0%'})[1]['updates']] == \
+        ['Safari 100%']
+    assert api_get(bot, '/search', {'q': 'S_1'})[1]['updates'] == []
+
+
+def test_commands_answer_in_the_language_of_the_page(bot, configure):
+    conn = configure(apple_url='https://support.apple.com/en-us/HT201222', message_format='text')
+    bot.page_scrape('en-us', Response(build_page(en_rows)), conn)
+    for command in ('/latest 1', '/search nothing', '/help'):
+        bot.command_answer('-1001', command)
+    assert [apprise_message for chat_id, apprise_message in bot.sent] == [
+        'Latest Apple updates\n\n2024-05-13 - iOS 17.5 and iPadOS 17.5 - iPhone XS and later\n\n',
+        'Search results: nothing\nNo results.\n\n',
+        'Commands: /latest [n], /search text, /since YYYY-MM-DD, /cve CVE-YYYY-NNNN\n\n']
+
+
+def test_incremental_exports_never_overwrite(bot, conn, tmp_path):
+    export_file = f'{tmp_path}/exports/updates-delta.jsonl'
+    os.mkdir(f'{tmp_path}/exports')
+    bot.page_scrape('es-cl', Response(build_page(es_rows)), conn)
+    bot.export(conn, export_file, None, True)
+    bot.export(conn, export_file, None, True)
+    bot.page_scrape('es-cl', Response(build_page(archive_rows[:1] + es_rows)), conn)
+    bot.export(conn, export_file, None, True)
+    assert sorted(os.listdir(f'{tmp_path}/exports')) == ['updates-delta-0000000001.jsonl',
+                                                         'updates-delta-0000000003.jsonl']
+
+
+def hold_run_lock(conn, owner, host, pid, heartbeat):
+    conn.execute('INSERT OR REPLACE INTO run_lock (lock_name, owner, host, pid, acquired_at, heartbeat) '
+                 "VALUES ('run', ?, ?, ?, ?, ?)", (owner, host, pid, heartbeat, heartbeat))
+    conn.commit()
+
+
+def test_overlapping_run_coalesces_onto_the_running_one(bot, configure):
+    conn = configure(lock_wait=10)
+    hold_run_lock(conn, 'other', 'elsewhere', 1, time.time())
+
+    def release():
+        other = sqlite3.connect(bot.db_file)
+        other.execute("UPDATE run_lock SET released_at = ?, result = '{}' WHERE owner = 'other'", (time.time(),))
+        other.commit()
+        other.close()
+
+    threading.Timer(0.5, release).start()
+    assert bot.run_lock_acquire(conn) is None
+    assert bot.run_metrics['runs_coalesced'] == 1
+
+
+def test_run_is_skipped_after_lock_wait(bot, configure):
+    conn = configure(lock_wait=0)
+    hold_run_lock(conn, 'other', 'elsewhere', 1, time.time())
+    assert bot.run_lock_acquire(conn) is None
+    assert bot.run_metrics['runs_skipped'] == 1
+
+
+def test_stale_run_lock_is_taken_over(bot, configure):
+    conn = configure(lock_wait=0)
+    # a lock not refreshed for lock_stale seconds
+    hold_run_lock(conn, 'other', 'elsewhere', 1, time.time() - 3600)
+    assert bot.run_lock_acquire(conn) is not None
+    # a lock of a process no longer running on this host
+    process = subprocess.Popen(['true'])
+    process.wait()
+    hold_run_lock(conn, 'other', socket.gethostname(), process.pid, time.time())
+    assert bot.run_lock_acquire(conn) is not None
+    assert bot.run_metrics['stale_locks'] == 2
+
+
+def test_cleared_digest_times_send_buffered_rows(bot, conn):
+    bot.schedule_set(conn, '-1001', None, ['09:00'], None, None)
+    bot.page_scrape('es-cl', Response(build_page(es_rows)), conn)
+    bot.digest_flush(conn)
+    assert conn.execute('SELECT COUNT(*) FROM digest_rows').fetchone() == (2,)
+    bot.schedule_set(conn, '-1001', None, [], None, None)
+    bot.digest_flush(conn)
+    bot.outbox_dispatch(conn)
+    assert conn.execute('SELECT COUNT(*) FROM digest_rows').fetchone() == (0,)
+    assert [chat_id for chat_id, apprise_message in bot.sent] == ['-1001']